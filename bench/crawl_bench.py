@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Run the spiders end to end against the local mock retailers and report
+throughput, memory and per-callback latency.
+
+    python -m bench.crawl_bench --locations 5000 --skus 500
+
+The project's settings, middlewares and extensions apply, with -s to
+override settings, e.g. -s ENDPOINT_THROTTLE_ENABLED=False to measure
+without the endpoint throttle. The crawl runs in a scratch directory (--workdir) holding its own watchlist,
+db and logs. Reusing a workdir measures a warm crawl. --crawls N crawls N
+times in a row in one process, like main.py daemon, and warm crawls should
+report no stock cache reloads.
+"""
+from pathlib import Path
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from bench import mock_server  # noqa: E402
+
+
+def _serve(port_queue, locations: int):
+    server = mock_server.serve(0, locations)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_mock_server(locations: int) -> (multiprocessing.Process, str):
+    """Serve the mock retailers from another process so the crawl gets the
+    whole interpreter. Return the process and its base URL.
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(port_queue, locations), daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}'.format(port_queue.get(timeout=30))
+
+
+def write_watchlist(path: Path, retailers: [str], skus: int, postal_codes: int):
+    codes = ['L{}T{}X{}'.format(i % 10, i // 10 % 10, i // 100 % 10) for i in range(postal_codes)]
+    urls = {'walmart': 'https://www.walmart.ca/en/ip/bench-product-{0}/{1}',
+            'bestbuy': 'https://www.bestbuy.ca/en-ca/product/bench-product-{0}/{1}'}
+    # Best Buy looks up stores by the first 3 characters of the postal code
+    bestbuy_codes = ['L{}{}'.format(i % 10, chr(ord('A') + i // 10 % 26)) + 'X1X1' for i in range(postal_codes)]
+
+    watchlist = {'retailers': {}}
+    for retailer in retailers:
+        watchlist['retailers'][retailer] = {
+            'postal_codes': bestbuy_codes if retailer == 'bestbuy' else codes,
+            'products': [{'url': urls[retailer].format(i, 10000000 + i)} for i in range(skus)],
+        }
+
+    path.write_text(json.dumps(watchlist, indent=1))
+
+
+def report(crawls: [(str, dict, dict)], peak_rss_kb: int):
+    """Print the (spider name, stats, callback histograms) of every crawl."""
+    for name, stats, histograms in sorted(crawls, key=lambda c: c[0]):
+        elapsed = stats.get('elapsed_time_seconds') or 1e-9
+
+        def rate(key: str) -> str:
+            return '{:>10.1f}/s  ({})'.format(stats.get(key, 0) / elapsed, stats.get(key, 0))
+
+        print('== {} ({:.2f}s, finish reason: {})'.format(name, elapsed, stats.get('finish_reason')))
+        print('  requests      ' + rate('downloader/response_count'))
+        print('  items         ' + rate('item_scraped_count'))
+        print('  observations  ' + rate('stock_writer/observations'))
+        print('  db writes     ' + rate('stock_writer/changes'))
+        print('  stock cache   {} reloads, {} hits'.format(
+            stats.get('stock_cache/reloads', 0), stats.get('stock_cache/hits', 0)))
+        print('  errors        {}'.format(stats.get('log_count/ERROR', 0)))
+
+        for callback, histogram in sorted(histograms.items()):
+            if not histogram.samples:
+                continue
+            print('  {} x{}: p50 {:.2f}ms  p95 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms'.format(
+                callback, len(histogram.samples),
+                histogram.percentile(0.5) * 1000, histogram.percentile(0.95) * 1000,
+                histogram.percentile(0.99) * 1000, max(histogram.samples) * 1000))
+            for bound, count in histogram.buckets():
+                print('    <= {:>9.3f}ms {:>7} {}'.format(bound, count, '#' * max(1, 40 * count // len(histogram.samples))))
+
+    print('== peak RSS {:.1f} MiB'.format(peak_rss_kb / 1024))
+
+
+def report_events(dao):
+    """Print how many stock events are in the log, and up to where each
+    subscriber has been delivered.
+    """
+    with dao.transaction() as conn:
+        appended = conn.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM stock_events').fetchone()
+        subscribers = conn.execute('SELECT name, last_event_id FROM event_subscribers ORDER BY name').fetchall()
+    print('== stock events: {} in the log, up to offset {}'.format(*appended))
+    for name, offset in subscribers:
+        print('  {:<12}  delivered up to {}'.format(name, offset))
+
+
+def run_crawls(settings, retailers: [str], times: int) -> [(str, dict, dict)]:
+    """Crawl the retailers times times in a row in one reactor. Return the
+    (name, stats, callback histograms) of every crawl, numbered after the
+    first.
+    """
+    from scrapy.crawler import CrawlerProcess
+
+    process = CrawlerProcess(settings)
+    from twisted.internet import defer, reactor  # installed by CrawlerProcess
+    crawls = []
+
+    @defer.inlineCallbacks
+    def crawl_all():
+        for i in range(times):
+            crawlers = [process.create_crawler(retailer) for retailer in retailers]
+            yield defer.DeferredList([process.crawl(crawler) for crawler in crawlers])
+            crawls.extend((c.spider.name + (' #{}'.format(i + 1) if i else ''), c.stats.get_stats(),
+                           c.callback_histograms) for c in crawlers)
+        reactor.stop()
+
+    crawl_all()
+    process.start(stop_after_crawl=False)
+    return crawls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the spiders against mock retailers')
+    parser.add_argument('--locations', type=int, default=100, help='store locations per availability response')
+    parser.add_argument('--skus', type=int, default=10, help='products watched per retailer')
+    parser.add_argument('--postal-codes', type=int, default=1, help='postal codes watched per retailer')
+    parser.add_argument('--retailers', default='walmart,bestbuy', help='comma separated spiders to run')
+    parser.add_argument('--workdir', help='scratch directory for the watchlist, db and logs')
+    parser.add_argument('--workers', type=int, default=1, help='crawl with this many sharded worker processes')
+    parser.add_argument('--crawls', type=int, default=1, help='crawl this many times in a row in one process')
+    parser.add_argument('--database-url', help='DATABASE_URL to write to instead of a sqlite db in the workdir')
+    parser.add_argument('--export-path', help="STOCK_EXPORT_PATH to export observations to, '' to not export")
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a setting, e.g. -s ENDPOINT_THROTTLE_ENABLED=False')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    mock, mock_url = start_mock_server(args.locations)
+
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'hyper_scraper.settings')
+    os.environ['HYPRSCRP_SLACK_HOOK_URL'] = mock_url + '/slack'
+    os.environ['HYPRSCRP_HEALTH_SLACK_HOOK_URL'] = mock_url + '/slack'
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='hyper_scraper_bench_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    retailers = args.retailers.split(',')
+    write_watchlist(workdir / 'watchlist.json', retailers, args.skus, args.postal_codes)
+    print('== workdir {}, mock retailers at {}'.format(workdir, mock_url))
+
+    from scrapy.utils.project import get_project_settings
+    from db.dao import Dao
+
+    settings = get_project_settings()
+    if args.database_url:
+        settings.set('DATABASE_URL', args.database_url)
+    Dao.from_settings(settings).setup_db()
+
+    settings.set('WATCHLIST_FILE', str(workdir / 'watchlist.json'))
+    settings.set('BENCH_MOCK_URL', mock_url)
+    settings.set('DOWNLOADER_MIDDLEWARES', dict(settings.getdict('DOWNLOADER_MIDDLEWARES'),
+                                                **{'bench.middlewares.MockRetailerMiddleware': 1}))
+    # The project's extensions run as in production, the metrics ones write
+    # their textfile to the workdir
+    settings.set('EXTENSIONS', dict(settings.getdict('EXTENSIONS'), **{'bench.middlewares.CallbackTimingExtension': 0}))
+    settings.set('METRICS_TEXTFILE', str(workdir / 'metrics.prom'))
+    settings.set('LOG_LEVEL', args.log_level)
+    if args.export_path is not None:
+        settings.set('STOCK_EXPORT_PATH', args.export_path)
+    # Measure full crawls, not the products adaptive polling picks
+    settings.set('ADAPTIVE_POLL_ENABLED', False)
+    for option in args.set:
+        name, _, value = option.partition('=')
+        settings.set(name, value, priority='cmdline')
+
+    if args.workers > 1:
+        from hyper_scraper.sharding import run_sharded
+
+        start = time.monotonic()
+        crawls = []
+        for name, shard_stats in run_sharded(settings, args.workers).items():
+            # Shards of a retailer crawl concurrently, count them as one crawl
+            stats = {key: sum(s.get(key, 0) for s in shard_stats)
+                     for key in ('downloader/response_count', 'item_scraped_count', 'log_count/ERROR')}
+            stats['elapsed_time_seconds'] = max(s.get('elapsed_time_seconds', 0) for s in shard_stats)
+            stats['finish_reason'] = '{} shards'.format(len(shard_stats))
+            crawls.append((name, stats, {}))
+        print('== {} workers, {:.2f}s wall'.format(args.workers, time.monotonic() - start))
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    else:
+        crawls = run_crawls(settings, retailers, args.crawls)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    from hyper_scraper.extensions import EventDispatchExtension
+    from notifs import events, slack
+    if EventDispatchExtension._dispatcher is not None:
+        EventDispatchExtension._dispatcher.stop(events.SHUTDOWN_TIMEOUT)  # delivers the crawls' events
+    slack.flush()
+    mock.terminate()
+
+    report(crawls, peak_rss)
+    report_events(Dao.from_settings(settings))
+
+
+if __name__ == '__main__':
+    main()
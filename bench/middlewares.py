@@ -0,0 +1,63 @@
+from hyper_scraper.middlewares import callback_timed
+
+RETAILER_HOSTS = ('https://www.walmart.ca', 'https://www.bestbuy.ca')
+
+
+class MockRetailerMiddleware(object):
+    """Downloader middleware sending retailer requests to BENCH_MOCK_URL."""
+
+    def __init__(self, mock_url: str):
+        self.mock_url = mock_url.rstrip('/')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('BENCH_MOCK_URL'))
+
+    def process_request(self, request, spider):
+        for host in RETAILER_HOSTS:
+            if request.url.startswith(host):
+                return request.replace(url=self.mock_url + request.url[len(host):])
+        return None
+
+
+class LatencyHistogram:
+    """Latencies bucketed by powers of two of a millisecond."""
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def buckets(self) -> [(float, int)]:
+        """Return (upper bound ms, count) of every non-empty bucket."""
+        counts = {}
+        for s in self.samples:
+            bound = 0.125
+            while s * 1000 > bound:
+                bound *= 2
+            counts[bound] = counts.get(bound, 0) + 1
+        return sorted(counts.items())
+
+
+class CallbackTimingExtension(object):
+    """Collects the callback times of CallbackTimingMiddleware into
+    LatencyHistograms.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # callback name:LatencyHistogram
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls()
+        crawler.callback_histograms = s.histograms  # read by the benchmark report
+        crawler.signals.connect(s.callback_timed, signal=callback_timed)
+        return s
+
+    def callback_timed(self, callback, seconds):
+        self.histograms.setdefault(callback, LatencyHistogram()).add(seconds)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Walmart and Best Buy endpoints used by the spiders.
+
+Responses are built from the fixtures in bench/fixtures, scaled up to the
+requested number of store locations per availability response. Slack webhook
+posts to /slack are accepted and counted.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import copy
+import json
+import zlib
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+
+def _fixture(name: str) -> str:
+    return (FIXTURES_DIR / name).read_text()
+
+
+def _upc(sku: str) -> str:
+    return sku.rjust(12, '0')
+
+
+class MockRetailers:
+    """Builds scaled responses from the fixtures, caching repeated bodies."""
+
+    def __init__(self, locations: int):
+        self.locations = locations
+
+        self._walmart_geo = json.loads(_fixture('walmart_geo_location.json'))
+        self._walmart_product_page = _fixture('walmart_product_page.html')
+        self._bestbuy_product_page = _fixture('bestbuy_product_page.html')
+
+        walmart_stock = json.loads(_fixture('walmart_find_in_store.json'))
+        loc = walmart_stock['info'][0]
+        walmart_stock['info'] = [dict(loc, id=i, displayName='{} {}'.format(loc['displayName'], i))
+                                 for i in range(locations)]
+        self._walmart_stock = json.dumps(walmart_stock).encode()
+
+        bestbuy_locations = json.loads(_fixture('bestbuy_locations.json'))
+        loc = bestbuy_locations['locations'][0]
+        bestbuy_locations['locations'] = [dict(loc, locationId=str(i), name='{} {}'.format(loc['name'], i))
+                                          for i in range(locations)]
+        self._bestbuy_locations = json.dumps(bestbuy_locations).encode()
+
+        self._bestbuy_availability = json.loads(_fixture('bestbuy_availability.json'))
+
+    def walmart_geo_location(self, postal_code: str) -> bytes:
+        # Spread postal codes over distinct coordinates
+        offset = zlib.crc32(postal_code.encode()) % 10000 / 1000
+        return json.dumps(dict(self._walmart_geo, postalCode=postal_code,
+                               lat=self._walmart_geo['lat'] + offset,
+                               lng=self._walmart_geo['lng'] - offset)).encode()
+
+    def walmart_find_in_store(self) -> bytes:
+        return self._walmart_stock
+
+    def walmart_product_page(self, sku: str) -> bytes:
+        return self._walmart_product_page.replace('{sku}', sku).replace('{upc}', _upc(sku)).encode()
+
+    def bestbuy_locations(self) -> bytes:
+        return self._bestbuy_locations
+
+    def bestbuy_availability(self, skus: [str], location_ids: [str]) -> bytes:
+        data = copy.deepcopy(self._bestbuy_availability)
+        availability = data['availabilities'][0]
+        loc = availability['pickup']['locations'][0]
+        locations = [dict(loc, locationKey=loc_id) for loc_id in location_ids]
+        data['availabilities'] = [dict(availability, sku=sku, pickup=dict(availability['pickup'], locations=locations))
+                                  for sku in skus]
+        return json.dumps(data).encode()
+
+    def bestbuy_product_page(self, sku: str) -> bytes:
+        return self._bestbuy_product_page.replace('{sku}', sku).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    retailers = None  # MockRetailers
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        if path == '/robots.txt':
+            self._reply(b'', 'text/plain')
+        elif path == '/api/product-page/geo-location':
+            self._reply(self.retailers.walmart_geo_location(query['postalCode']), 'application/json')
+        elif path == '/api/product-page/find-in-store':
+            self._reply(self.retailers.walmart_find_in_store(), 'application/json')
+        elif path.startswith('/en/ip/'):
+            self._reply(self.retailers.walmart_product_page(path.split('/')[-1]), 'text/html')
+        elif path == '/api/v2/json/locations':
+            self._reply(self.retailers.bestbuy_locations(), 'application/json')
+        elif path == '/ecomm-api/availability/products':
+            self._reply(self.retailers.bestbuy_availability(query['skus'].split('|'), query['locations'].split('|')),
+                        'application/json')
+        elif path.startswith('/en-ca/product/'):
+            self._reply(self.retailers.bestbuy_product_page(path.split('/')[-1]), 'text/html')
+        else:
+            self._reply(b'not found', 'text/plain', status=404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply(b'ok', 'text/plain')
+
+
+def serve(port: int, locations: int) -> ThreadingHTTPServer:
+    """Return a mock server bound to 127.0.0.1:port (0 picks a free port)."""
+    handler = type('Handler', (_Handler,), {'retailers': MockRetailers(locations)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve mock retailer endpoints')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--locations', type=int, default=100, help='store locations per availability response')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.locations)
+    print('Serving mock retailers on http://127.0.0.1:{}'.format(server.server_port))
+    server.serve_forever()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Measure how long main.py commands take to start and run, and what they
+import.
+
+    python -m bench.startup_bench --runs 10 stock compact "report restocks"
+
+Each run is a fresh interpreter in a scratch directory (--workdir) with an
+empty db and no slack hooks. Commands that load Scrapy, Twisted or lxml are
+flagged, only crawling should need them. Each command is also run in a new
+directory with no db at all, which it must create.
+"""
+from pathlib import Path
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+HEAVY_MODULES = ('scrapy', 'twisted', 'lxml')
+
+
+def run(command: [str], workdir: Path, env: dict) -> (float, float, {str}):
+    """Return the wall seconds and import seconds of a run of main.py, and
+    the top level packages it imported.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(REPO_DIR / 'main.py')] + command,
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('main.py {} failed:\n{}'.format(' '.join(command), result.stderr[-2000:]))
+
+    import_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        import_us += int(self_us)
+        packages.add(name.strip().split('.')[0])
+    return wall, import_us / 1e6, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup of main.py commands')
+    parser.add_argument('commands', nargs='*', default=['stock', 'compact', 'report restocks'])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--workdir', help='scratch directory for the db')
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='hyper_scraper_startup_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    env = {k: v for k, v in os.environ.items() if not k.startswith('HYPRSCRP_')}
+    env.setdefault('SCRAPY_SETTINGS_MODULE', 'hyper_scraper.settings')
+    run(['compact'], workdir, env)  # creates the db
+
+    print('== workdir {}, {} runs each'.format(workdir, args.runs))
+    for command in args.commands:
+        runs = [run(command.split(), workdir, env) for _ in range(args.runs)]
+        walls = [r[0] for r in runs]
+        imports = [r[1] for r in runs]
+        heavy = sorted(p for p in runs[0][2] if p in HEAVY_MODULES)
+        print('  {:<24} wall p50 {:7.1f}ms  min {:7.1f}ms   imports p50 {:7.1f}ms{}'.format(
+            command, statistics.median(walls) * 1000, min(walls) * 1000, statistics.median(imports) * 1000,
+            '   loads ' + ', '.join(heavy) if heavy else ''))
+
+    for command in args.commands:
+        walls = [run(command.split(), Path(tempfile.mkdtemp(dir=str(workdir))), env)[0] for _ in range(args.runs)]
+        print('  {:<24} wall p50 {:7.1f}ms  min {:7.1f}ms'.format(
+            command + ' (no db)', statistics.median(walls) * 1000, min(walls) * 1000))
+
+    baseline = [run_python(['-c', 'pass']) for _ in range(args.runs)]
+    print('  {:<24} wall p50 {:7.1f}ms'.format('(python -c pass)', statistics.median(baseline) * 1000))
+
+
+def run_python(argv: [str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + argv, check=True)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Restock analytics over the stock history of both the db and the compacted
+history segments, computed with NumPy over whole columns at once.
+
+    python main.py report restocks --since 30 --store walmart --format csv
+"""
+from collections import namedtuple
+import argparse
+import csv
+import json
+import sys
+import time
+import numpy as np
+from db import history
+from db.dao import Dao
+
+DAY = 24 * 60 * 60
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# Columns of each report, in order
+_WHERE = ['product', 'store', 'location']
+REPORT_COLUMNS = {
+    'restocks': ['time'] + _WHERE + ['quantity', 'price'],
+    'in-stock-time': _WHERE + ['observed_hours', 'in_stock_hours', 'in_stock_fraction'],
+    'prices': ['time'] + _WHERE + ['old_price', 'new_price'],
+    'restock-hours': ['store', 'restocks'] + ['hour_{:02}'.format(hour) for hour in range(24)] + list(WEEKDAYS),
+}
+
+# Columns of stock changes sorted by (product_id, store_id, location_id,
+# last_updated, id). quantity and price are floats, NaN where NULL.
+StockHistory = namedtuple('StockHistory', 'id last_updated product_id store_id location_id quantity price')
+
+
+def load_history(dao: Dao, since: int = None, until: int = None, store_id: int = None) -> StockHistory:
+    """Load every stock change in [since, until), optionally only of a store."""
+    parts = []
+    for path in history.segment_paths(dao.history_dir, since, until):
+        columns = history.read_columns(path)
+        quantity = np.frombuffer(columns['quantity'], dtype=np.int64).astype(np.float64)
+        quantity[quantity == history.NULL_QUANTITY] = np.nan
+        parts.append([np.frombuffer(columns['id'], dtype=np.int64),
+                      np.frombuffer(columns['last_updated'], dtype=np.int64),
+                      np.frombuffer(columns['product_id'], dtype=np.int64),
+                      np.frombuffer(columns['store_id'], dtype=np.int64),
+                      np.frombuffer(columns['location_id'], dtype=np.int64),
+                      quantity,
+                      np.frombuffer(columns['price'], dtype=np.float64)])
+
+    rows = dao.hot_stock_changes(since, until, store_id)
+    hot = np.array(rows, dtype=np.float64).reshape(-1, 7)  # NULLs become NaN
+    parts.append([hot[:, i].astype(np.int64) for i in range(5)] + [hot[:, 5], hot[:, 6]])
+
+    columns = [np.concatenate([part[i] for part in parts]) for i in range(7)]
+    ids, last_updated, product_id, store, _, _, _ = columns
+
+    # Segments cover whole months, and rows of an interrupted compaction can
+    # be in both tiers
+    keep = np.ones(len(ids), dtype=bool)
+    if since is not None:
+        keep &= last_updated >= since
+    if until is not None:
+        keep &= last_updated < until
+    if store_id is not None:
+        keep &= store == store_id
+    _, first = np.unique(ids, return_index=True)
+    unique = np.zeros(len(ids), dtype=bool)
+    unique[first] = True
+    keep &= unique
+
+    columns = [c[keep] for c in columns]
+    order = np.lexsort((columns[0], columns[1], columns[4], columns[3], columns[2]))
+    return StockHistory(*(c[order] for c in columns))
+
+
+def _group_starts(h: StockHistory) -> np.ndarray:
+    """Return whether each change is the first of its product location."""
+    starts = np.ones(len(h.id), dtype=bool)
+    starts[1:] = ((h.product_id[1:] != h.product_id[:-1]) | (h.store_id[1:] != h.store_id[:-1])
+                  | (h.location_id[1:] != h.location_id[:-1]))
+    return starts
+
+
+def _previous(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Return the previous value of each change's product location, NaN for
+    the first.
+    """
+    previous = np.empty(len(values), dtype=np.float64)
+    previous[0:1] = np.nan
+    previous[1:] = values[:-1]
+    previous[starts] = np.nan
+    return previous
+
+
+def restocks(h: StockHistory) -> np.ndarray:
+    """Return the indices of changes from out of stock to in stock."""
+    previous = _previous(h.quantity, _group_starts(h))
+    return np.flatnonzero((previous == 0) & (h.quantity > 0))
+
+
+def time_in_stock(h: StockHistory, until: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Return the indices of the first change of each product location, with
+    the seconds it was observed and in stock for from then until until.
+    """
+    starts = _group_starts(h)
+    group = np.cumsum(starts) - 1
+    ends = np.empty(len(h.id), dtype=np.int64)
+    ends[:-1] = h.last_updated[1:]
+    ends[-1:] = until
+    ends[np.flatnonzero(starts)[1:] - 1] = until  # the last change of a group lasts until now
+    durations = np.maximum(ends - h.last_updated, 0)
+
+    observed = np.bincount(group, weights=durations)
+    in_stock = np.bincount(group, weights=np.where(h.quantity > 0, durations, 0))
+    return np.flatnonzero(starts), observed, in_stock
+
+
+def price_changes(h: StockHistory) -> (np.ndarray, np.ndarray):
+    """Return the indices of changes to a new known price, with the previous
+    price, NaN if unknown.
+    """
+    starts = _group_starts(h)
+    known = ~np.isnan(h.price)
+
+    # Carry the last known price of each product location forward
+    last_known = np.where(known | starts, np.arange(len(h.id)), 0)
+    np.maximum.accumulate(last_known, out=last_known)
+    previous = _previous(h.price[last_known], starts)
+
+    changed = known & (previous != h.price)
+    return np.flatnonzero(changed), previous[changed]
+
+
+def restock_hours(h: StockHistory) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Return the store IDs with restocks, and the counts of their restocks
+    per UTC hour of day (stores x 24) and per weekday, Monday first (stores x 7).
+    """
+    i = restocks(h)
+    stores, store_index = np.unique(h.store_id[i], return_inverse=True)
+    hours = h.last_updated[i] // 3600 % 24
+    weekdays = (h.last_updated[i] // DAY + 3) % 7  # the epoch was a Thursday
+
+    per_hour = np.bincount(store_index * 24 + hours, minlength=len(stores) * 24).reshape(-1, 24)
+    per_weekday = np.bincount(store_index * 7 + weekdays, minlength=len(stores) * 7).reshape(-1, 7)
+    return stores, per_hour, per_weekday
+
+
+def _iso(utc_epochs: np.ndarray) -> [str]:
+    return np.datetime_as_string(utc_epochs.astype('datetime64[s]'), unit='s').tolist()
+
+
+def _optional(values: np.ndarray) -> list:
+    return [None if v != v else v for v in values.tolist()]
+
+
+def report(dao: Dao, kind: str, since: int = None, store_name: str = None) -> [dict]:
+    """Return the rows of a report: restocks, in-stock-time, prices or
+    restock-hours. Rows have the REPORT_COLUMNS of the report.
+    """
+    products, stores, locations = dao.dimension_names()
+    store_id = None
+    if store_name is not None:
+        ids = [i for i, name in stores.items() if name.lower() == store_name.lower()]
+        if not ids:
+            return []
+        store_id = ids[0]
+
+    now = int(time.time())
+    h = load_history(dao, since, now, store_id)
+    if len(h.id) == 0:
+        return []
+
+    def columns(i: np.ndarray) -> dict:
+        return {'product': [products[p] for p in h.product_id[i].tolist()],
+                'store': [stores[s] for s in h.store_id[i].tolist()],
+                'location': [locations[loc] for loc in h.location_id[i].tolist()]}
+
+    if kind == 'restocks':
+        i = restocks(h)
+        data = dict(time=_iso(h.last_updated[i]), **columns(i), quantity=_optional(h.quantity[i]),
+                    price=_optional(h.price[i]))
+    elif kind == 'in-stock-time':
+        i, observed, in_stock = time_in_stock(h, now)
+        data = dict(**columns(i), observed_hours=np.round(observed / 3600, 2).tolist(),
+                    in_stock_hours=np.round(in_stock / 3600, 2).tolist(),
+                    in_stock_fraction=np.round(in_stock / np.maximum(observed, 1), 4).tolist())
+    elif kind == 'prices':
+        i, previous = price_changes(h)
+        data = dict(time=_iso(h.last_updated[i]), **columns(i), old_price=_optional(previous),
+                    new_price=_optional(h.price[i]))
+    elif kind == 'restock-hours':
+        store_ids, per_hour, per_weekday = restock_hours(h)
+        data = {'store': [stores[s] for s in store_ids.tolist()], 'restocks': per_hour.sum(axis=1).tolist()}
+        data.update(('hour_{:02}'.format(hour), per_hour[:, hour].tolist()) for hour in range(24))
+        data.update((day, per_weekday[:, d].tolist()) for d, day in enumerate(WEEKDAYS))
+    else:
+        raise ValueError('unknown report: {}'.format(kind))
+
+    return [dict(zip(data, row)) for row in zip(*data.values())]
+
+
+def main(argv: [str], dao: Dao):
+    parser = argparse.ArgumentParser(prog='main.py report', description='Report on the stock history')
+    parser.add_argument('kind', choices=list(REPORT_COLUMNS))
+    parser.add_argument('--since', type=float, help='only the last SINCE days')
+    parser.add_argument('--store', help='only this store, e.g. walmart')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--output', help='file to write to instead of stdout')
+    args = parser.parse_args(argv)
+
+    since = int(time.time() - args.since * DAY) if args.since is not None else None
+    rows = report(dao, args.kind, since, args.store)
+
+    f = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump(rows, f, indent=1)
+            f.write('\n')
+        else:
+            # The header even without rows, so the columns never change
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS[args.kind])
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if f is not sys.stdout:
+            f.close()
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from db.dao import Dao
+
+
+class LatestStockCache:
+    """Bounded LRU cache of the last known (quantity, price) per
+    (product_name, store_id, location).
+
+    The cache is warmed with Dao.latest_product_stock and is reloaded once
+    another connection has committed stock to the database, as reported by
+    Dao.data_version. Stock written through the cache's own connection and
+    writes to other tables don't reload it.
+    """
+
+    def __init__(self, dao: Dao, max_size: int):
+        self.dao = dao
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (product_name, store_id, location):(quantity, price)
+        self._data_version = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, conn) -> None:
+        """Replace the cache contents with the latest stock in the database."""
+        self._entries.clear()
+        self._data_version = self.dao.data_version(conn)
+        for product_name, store_id, location, quantity, price in self.dao.latest_product_stock(conn, self.max_size):
+            self._entries[(product_name, store_id, location)] = (quantity, price)
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+
+    def sync(self, conn) -> bool:
+        """Reload the cache if another connection has committed stock since
+        it was last loaded. Return true if the cache was reloaded.
+        """
+        if self.dao.data_version(conn) == self._data_version:
+            return False
+
+        self.load(conn)
+        return True
+
+    def get(self, key: tuple):
+        """Return the last known (quantity, price) for key, or None."""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: tuple, quantity: int, price: float) -> None:
+        self._entries[key] = (quantity, price)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def is_unchanged(self, key: tuple, quantity: int, price: float) -> bool:
+        return self.get(key) == (quantity, price)
@@ -1,177 +1,598 @@
+from collections import namedtuple
+from contextlib import contextmanager
 from pathlib import Path
-import sqlite3
+from db import history
+from db.backends import ConnectionPool, backend_from_url
+from metrics import prometheus
+import time
+
+# sqlite's NOCASE collation only folds ASCII letters
+_NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+# Keep bound parameters per statement under sqlite's historical limit of 999
+_MAX_VARIABLES = 900
+
+DAY = 24 * 60 * 60
+
+# Kinds of stock event
+RESTOCK = 'restock'  # in stock after being out of stock or never seen
+SOLD_OUT = 'sold_out'
+PRICE_CHANGE = 'price_change'
+
+# A stock event as subscribers read it, offset being its position in the log
+StockEvent = namedtuple('StockEvent', 'offset kind observed_at retailer product_name location '
+                                      'old_quantity quantity old_price price')
+
+
+QUERY_SECONDS = prometheus.histogram('hyper_scraper_db_query_seconds', 'Time spent in Dao queries', ('query',))
+ROWS_WRITTEN = prometheus.counter('hyper_scraper_db_rows_written_total', 'Rows written by Dao', ('table',))
+
+
+def _nocase(s: str) -> str:
+    return s.translate(_NOCASE)
+
+
+def _chunks(seq: list, size: int):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _event_kinds(old_quantity: int, old_price: float, quantity: int, price: float) -> [str]:
+    """Return the kinds of stock event of a stock change, None old values
+    meaning the stock was never recorded.
+    """
+    kinds = []
+    if quantity and not old_quantity:
+        kinds.append(RESTOCK)
+    elif old_quantity and not quantity:
+        kinds.append(SOLD_OUT)
+    if old_price is not None and price is not None and price != old_price:
+        kinds.append(PRICE_CHANGE)
+    return kinds
+
+
+class DimensionIds:
+    """In process cache of store, product and store location IDs.
+
+    Names are resolved in bulk: cached names cost nothing, and all missing
+    names are inserted with ON CONFLICT DO NOTHING and selected back in one
+    query per chunk, so concurrent writers resolve to the same rows. They are
+    inserted in sorted order so concurrent writers lock them in the same
+    order.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stores = {}  # nocase name:id
+        self.products = {}  # nocase name:id
+        self.locations = {}  # (store_id, nocase location):id
+
+    def clear(self) -> None:
+        self.stores.clear()
+        self.products.clear()
+        self.locations.clear()
+
+    def store_ids(self, conn, names) -> dict:
+        """Return {name: id} for the given store names, inserting missing stores."""
+        return self._name_ids(conn, 'stores', self.stores, names)
+
+    def product_ids(self, conn, names) -> dict:
+        """Return {name: id} for the given product names, inserting missing products."""
+        return self._name_ids(conn, 'products', self.products, names)
+
+    def location_ids(self, conn, store_locations) -> dict:
+        """Return {(store_id, location): id} for the given store locations,
+        inserting missing locations.
+        """
+        keys = {(store_id, location): (store_id, _nocase(location)) for store_id, location in store_locations}
+        missing = sorted({nk: k for k, nk in keys.items() if nk not in self.locations}.items())
+
+        for chunk in _chunks(missing, _MAX_VARIABLES // 2):
+            conn.executemany('INSERT INTO store_locations(store_id, location) VALUES (?, ?) ON CONFLICT DO NOTHING',
+                             [k for _, k in chunk])
+            rows = conn.execute('SELECT id, store_id, location FROM store_locations WHERE (store_id, {}) IN '
+                                '(VALUES {})'.format(self.backend.nocase('location'), ','.join(['(?, ?)'] * len(chunk))),
+                                [v for nk, _ in chunk for v in nk])
+            for loc_id, store_id, location in rows:
+                self.locations[(store_id, _nocase(location))] = loc_id
+
+        return {k: self.locations[nk] for k, nk in keys.items()}
+
+    def _name_ids(self, conn, table: str, cache: dict, names) -> dict:
+        keys = {name: _nocase(name) for name in names}
+        missing = sorted({k: name for name, k in keys.items() if k not in cache}.items())
+
+        for chunk in _chunks(missing, _MAX_VARIABLES):
+            conn.executemany('INSERT INTO {}(name) VALUES (?) ON CONFLICT DO NOTHING'.format(table),
+                             [(name,) for _, name in chunk])
+            rows = conn.execute('SELECT id, name FROM {} WHERE {} IN ({})'.format(
+                table, self.backend.nocase('name'), ','.join('?' * len(chunk))), [k for k, _ in chunk])
+            for row_id, name in rows:
+                cache[_nocase(name)] = row_id
+
+        return {name: cache[k] for name, k in keys.items()}
 
 
 class Dao:
-    DB_FILE = 'db/hyper_scraper.db'
+    """Stores stock, crawl caches and stock history in the database of a
+    backend (see db.backends) and the history segments in history_dir.
 
-    @staticmethod
-    def setup_db():
-        Path('db').mkdir(parents=True, exist_ok=True)
-        with sqlite3.connect('db/hyper_scraper.db') as conn:  # Creates the db
-            c = conn.cursor()
-
-            c.execute("""
-CREATE TABLE IF NOT EXISTS stores (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT COLLATE NOCASE UNIQUE NOT NULL
-);
-""")
-
-            c.execute("""
-CREATE TABLE IF NOT EXISTS store_locations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    store_id INTEGER NOT NULL,
-    location TEXT COLLATE NOCASE NOT NULL
-);
-""")
-
-            c.execute("""
-CREATE TABLE IF NOT EXISTS products (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT COLLATE NOCASE UNIQUE NOT NULL
-);
-""")
-
-            c.execute("""
-CREATE TABLE IF NOT EXISTS product_stock (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    last_updated INTEGER NOT NULL,
-    product_id INTEGER NOT NULL,
-    store_id INTEGER NOT NULL,
-    location_id INTEGER NOT NULL,
-    quantity INTEGER,
-    price REAL,
-    FOREIGN KEY(product_id) REFERENCES products(id)
-    FOREIGN KEY(store_id) REFERENCES stores(id),
-    FOREIGN KEY(location_id) REFERENCES store_locations(id)
-);
-""")
+    Queries take a connection from a pool of up to pool_size idle
+    connections and run in a transaction of their own. Long-lived writers
+    hold their own connection from connect() instead, and pass it to the
+    methods taking a conn.
+    """
+    _instances = {}  # (database url, pool size, history dir, read only):Dao
 
-            conn.commit()
+    def __init__(self, backend, pool_size: int = 4, history_dir: str = 'db/history'):
+        self.backend = backend
+        self.history_dir = history_dir
+        self.pool = ConnectionPool(backend, pool_size)
+        self.ids = DimensionIds(backend)
 
-    @staticmethod
-    def get_store_id(store_name: str) -> int:
-        """Return store ID of the given store. Inserts the store if not present."""
-        store_id = -1
+    @classmethod
+    def from_settings(cls, settings) -> 'Dao':
+        """Return the process's Dao of the DATABASE_URL setting."""
+        return cls.from_url(settings.get('DATABASE_URL'), settings.getint('DATABASE_POOL_SIZE'),
+                            settings.get('HISTORY_DIR'))
 
-        with sqlite3.connect(Dao.DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute('SELECT id FROM stores WHERE name=?', (store_name,))
+    @classmethod
+    def from_url(cls, url: str, pool_size: int = 4, history_dir: str = 'db/history', read_only: bool = False) -> 'Dao':
+        """Return the process's Dao of a database URL. A read-only Dao can
+        only query, and doesn't create or migrate the db.
+        """
+        key = (url, pool_size, history_dir, read_only)
+        if key not in cls._instances:
+            cls._instances[key] = cls(backend_from_url(url, read_only), pool_size, history_dir)
+        return cls._instances[key]
 
-            row = c.fetchone()
-            if row is not None:
-                store_id = row[0]
-            else:
-                c.execute('INSERT INTO stores(name) VALUES (?)', (store_name,))
-                store_id = c.lastrowid
+    def setup_db(self) -> None:
+        """Create the db if needed and apply any pending migrations."""
+        self.backend.migrate()
 
-        return store_id
+    def is_migrated(self) -> bool:
+        """Return whether the db exists with every migration applied."""
+        return self.backend.migrated()
 
-    @staticmethod
-    def record_latest_product_stock(utc_epoch: int, product_name: str, store_id: int, location: str,
+    def connect(self):
+        """Return a new connection to the database. Intended to be held open by
+        long-lived writers rather than reconnecting per record.
+        """
+        return self.backend.connect()
+
+    @contextmanager
+    def transaction(self, conn=None):
+        """Run the block in a transaction on conn, or else on a pooled
+        connection, committing it unless the block raises.
+        """
+        pooled = conn is None
+        if pooled:
+            conn = self.pool.get()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if pooled:
+                self.pool.put(conn)
+
+    def get_store_id(self, store_name: str) -> int:
+        """Return store ID of the given store. Inserts the store if not present."""
+        with self.transaction() as conn:
+            return self.ids.store_ids(conn, [store_name])[store_name]
+
+    def record_latest_product_stock(self, utc_epoch: int, product_name: str, store_id: int, location: str,
                                     quantity: int, price: float) -> bool:
         """Records the latest product stock. No record is inserted if nothing
         has changed. Return true if there has been a stock change or the stock
         has been recorded for the first time with greater than zero items.
         """
-        stock_change = False
-
-        with sqlite3.connect(Dao.DB_FILE) as conn:
-            c = conn.cursor()
-
-            c.execute("""
-SELECT ps.id, ps.last_updated, ps.location_id, ps.quantity, ps.price, p.id
-FROM product_stock AS ps
-INNER JOIN store_locations AS sl ON sl.id = ps.location_id
-INNER JOIN products AS p ON p.id=ps.product_id
-WHERE p.name=? AND ps.store_id=? AND sl.location=?
-ORDER BY ps.last_updated DESC""",
-                      (product_name, store_id, location))
-            row_product_stock = c.fetchone()
-
-            if row_product_stock is None:
-                # Record new product
-
-                # Store
-                c.execute('SELECT id FROM store_locations WHERE store_id=? AND location=?',
-                          (store_id, location))
-                loc_id = -1
-                row_loc = c.fetchone()
-                if row_loc is not None:
-                    loc_id = row_loc[0]
-                else:
-                    c.execute('INSERT INTO store_locations(store_id, location) VALUES (?, ?)',
-                              (store_id, location))
-                    loc_id = c.lastrowid
-
-                # Product
-                c.execute('SELECT id FROM products WHERE name=?', (product_name,))
-                product_id = -1
-                row_products = c.fetchone()
-                if row_products is not None:
-                    product_id = row_products[0]
-                else:
-                    c.execute('INSERT INTO products(name) VALUES (?)', (product_name,))
-                    product_id = c.lastrowid
+        with self.transaction() as conn:
+            return self.record_latest_product_stock_batch(
+                conn, [(utc_epoch, product_name, store_id, location, quantity, price)])[0]
 
-                # Product stock
-                c.execute('INSERT INTO product_stock(last_updated, product_id, store_id, '
-                          'location_id, quantity, price) VALUES (?, ?, ?, ?, ?, ?)',
-                          (utc_epoch, product_id, store_id, loc_id,
-                           quantity, price))
+    @QUERY_SECONDS.time(query='record_latest_product_stock_batch')
+    def record_latest_product_stock_batch(self, conn, observations: [tuple]) -> [bool]:
+        """Records a batch of stock observations in a single transaction.
 
-                if quantity > 0:
-                    stock_change = True
+        Each observation is a tuple of (utc_epoch, product_name, store_id,
+        location, quantity, price). Observations are applied in order with the
+        same semantics as record_latest_product_stock, and the stock change
+        result for each one is returned in the same order.
+
+        The restocks, sell outs and price changes among the stock changes are
+        appended to the stock event log in the same transaction. An event
+        another writer already appended for the same change is skipped.
+        Raises ValueError, writing nothing, if an observation has no product
+        name or location.
+        """
+        unnamed = [o for o in observations if not o[1] or not o[3]]
+        if unnamed:
+            raise ValueError('stock observations without a product name or location: {}'.format(unnamed[:3]))
+
+        stock_changes = []
+        new_rows = []
+        events = []
 
-            else:
-                # Check old product
-                loc_id = row_product_stock[2]
-                old_quantity = row_product_stock[3]
-                old_price = row_product_stock[4]
-                product_id = row_product_stock[5]
-                if quantity != old_quantity or price != old_price:
+        with self.transaction(conn):
+            loc_ids = self.ids.location_ids(conn, {(o[2], o[3]) for o in observations})
+            product_ids = self.ids.product_ids(conn, {o[1] for o in observations})
+            stock_keys = [(product_ids[o[1]], o[2], loc_ids[(o[2], o[3])]) for o in observations]
+            # (product_id, store_id, loc_id):(quantity, price, last_updated)
+            latest = self._latest_stock(conn, set(stock_keys))
+
+            for stock_key, (utc_epoch, _, _, _, quantity, price) in zip(stock_keys, observations):
+                old = latest.get(stock_key)
+
+                if old is None:
+                    # Record new product
+                    stock_change = quantity > 0
+                elif quantity != old[0] or price != old[1]:
                     # Something changed, add new entry
-                    c.execute('INSERT INTO product_stock(last_updated, product_id, store_id, location_id, '
-                              'quantity, price) VALUES(?, ?, ?, ?, ?, ?)',
-                              (utc_epoch, product_id, store_id, loc_id, quantity, price))
                     stock_change = True
-
                 else:
                     # Nothing new
-                    assert stock_change is False
+                    stock_changes.append(False)
+                    continue
 
-        return stock_change
+                new_rows.append((utc_epoch, *stock_key, quantity, price))
+                old_quantity, old_price, old_updated = old or (None, None, 0)
+                events.extend((kind, utc_epoch, *stock_key, old_updated, old_quantity, quantity, old_price, price)
+                              for kind in _event_kinds(old_quantity, old_price, quantity, price))
+                latest[stock_key] = (quantity, price, utc_epoch)
+                stock_changes.append(stock_change)
+
+            if new_rows:
+                conn.executemany('INSERT INTO product_stock(last_updated, product_id, store_id, '
+                                 'location_id, quantity, price) VALUES (?, ?, ?, ?, ?, ?)',
+                                 new_rows)
+            if events:
+                self.backend.lock_stock_events(conn)
+                appended = conn.executemany('INSERT INTO stock_events(kind, observed_at, product_id, store_id, '
+                                            'location_id, previous_updated, old_quantity, quantity, old_price, price) '
+                                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+                                            events).rowcount
+                ROWS_WRITTEN.inc(appended, table='stock_events')
+        self.backend.stock_committed(conn, len(new_rows))
+        ROWS_WRITTEN.inc(len(new_rows), table='product_stock')
+
+        return stock_changes
 
     @staticmethod
-    def products_in_stock() -> str:
+    def _latest_stock(conn, stock_keys: set) -> dict:
+        """Return {(product_id, store_id, location_id): (quantity, price,
+        last_updated)} for the given keys that have any recorded stock.
+        """
+        latest = {}
+        for chunk in _chunks(list(stock_keys), _MAX_VARIABLES // 3):
+            rows = conn.execute('SELECT product_id, store_id, location_id, quantity, price, last_updated '
+                                'FROM latest_stock WHERE (product_id, store_id, location_id) IN (VALUES {})'.format(
+                                    ','.join(['(?, ?, ?)'] * len(chunk))),
+                                [v for k in chunk for v in k])
+            for product_id, store_id, location_id, quantity, price, last_updated in rows:
+                latest[(product_id, store_id, location_id)] = (quantity, price, last_updated)
+
+        return latest
+
+    @QUERY_SECONDS.time(query='stock_events')
+    def stock_events(self, after: int, limit: int) -> [StockEvent]:
+        """Return up to limit stock events after the offset after, oldest
+        first.
+        """
+        with self.transaction() as conn:
+            rows = conn.execute("""
+SELECT e.id, e.kind, e.observed_at, s.name, p.name, sl.location, e.old_quantity, e.quantity, e.old_price, e.price
+FROM stock_events AS e
+INNER JOIN stores AS s ON s.id=e.store_id
+INNER JOIN store_locations AS sl ON sl.id=e.location_id
+INNER JOIN products AS p ON p.id=e.product_id
+WHERE e.id>?
+ORDER BY e.id
+LIMIT ?""", (after, limit)).fetchall()
+        return [StockEvent(*row) for row in rows]
+
+    @QUERY_SECONDS.time(query='lease_event_subscriber')
+    def lease_event_subscriber(self, name: str, owner: str, lease_for: float) -> int:
+        """Take or renew owner's lease on delivering stock events to the
+        subscriber name for lease_for seconds. Return the offset of the last
+        event delivered to it, or None if another owner holds the lease.
+
+        A new subscriber starts at the end of the log.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO event_subscribers(name, last_event_id, owner, lease_until) '
+                         'SELECT ?, COALESCE(MAX(id), 0), NULL, 0 FROM stock_events WHERE true '
+                         'ON CONFLICT DO NOTHING', (name,))
+            leased = conn.execute('UPDATE event_subscribers SET owner=?, lease_until=? '
+                                  'WHERE name=? AND (owner=? OR lease_until<?)',
+                                  (owner, now + lease_for, name, owner, now)).rowcount
+            if not leased:
+                return None
+            return conn.execute('SELECT last_event_id FROM event_subscribers WHERE name=?', (name,)).fetchone()[0]
+
+    @QUERY_SECONDS.time(query='save_event_offset')
+    def save_event_offset(self, name: str, owner: str, offset: int) -> bool:
+        """Record that the stock events up to offset were delivered to the
+        subscriber name. Return false if owner lost its lease meanwhile.
+        """
+        with self.transaction() as conn:
+            return conn.execute('UPDATE event_subscribers SET last_event_id=? '
+                                'WHERE name=? AND owner=? AND last_event_id<?',
+                                (offset, name, owner, offset)).rowcount == 1
+
+    def release_event_subscriber(self, name: str, owner: str) -> None:
+        """End owner's lease on the subscriber name, if it holds it."""
+        with self.transaction() as conn:
+            conn.execute('UPDATE event_subscribers SET lease_until=0 WHERE name=? AND owner=?', (name, owner))
+
+    @QUERY_SECONDS.time(query='get_cached_locations')
+    def get_cached_locations(self, retailer: str, postal_code: str, max_age: int) -> str:
+        """Return the cached location payload of the retailer for the postal
+        code, or None if there is none newer than max_age seconds.
+        """
+        with self.transaction() as conn:
+            row = conn.execute('SELECT payload FROM location_cache '
+                               'WHERE retailer=? AND postal_code=? AND fetched_at>=?',
+                               (retailer, postal_code, int(time.time()) - max_age)).fetchone()
+
+        return row[0] if row is not None else None
+
+    @QUERY_SECONDS.time(query='cache_locations')
+    def cache_locations(self, retailer: str, postal_code: str, payload: str) -> None:
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO location_cache(retailer, postal_code, fetched_at, payload) '
+                         'VALUES (?, ?, ?, ?) ON CONFLICT(retailer, postal_code) DO UPDATE SET '
+                         'fetched_at=excluded.fetched_at, payload=excluded.payload',
+                         (retailer, postal_code, int(time.time()), payload))
+        ROWS_WRITTEN.inc(table='location_cache')
+
+    @QUERY_SECONDS.time(query='get_product_metadata')
+    def get_product_metadata(self, retailer: str, urls: [str], max_age: int) -> dict:
+        """Return {url: (name, upc, price)} of the retailer's product pages
+        that were scraped less than max_age seconds ago.
+        """
+        metadata = {}
+        min_fetched_at = int(time.time()) - max_age
+        with self.transaction() as conn:
+            for chunk in _chunks(list(urls), _MAX_VARIABLES - 2):
+                rows = conn.execute('SELECT url, name, upc, price FROM product_metadata '
+                                    'WHERE retailer=? AND fetched_at>=? AND url IN ({})'.format(','.join('?' * len(chunk))),
+                                    [retailer, min_fetched_at] + chunk)
+                for url, name, upc, price in rows:
+                    metadata[url] = (name, upc, price)
+
+        return metadata
+
+    @QUERY_SECONDS.time(query='save_product_metadata')
+    def save_product_metadata(self, retailer: str, url: str, name: str, upc: str = None, price: float = None) -> None:
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO product_metadata(retailer, url, fetched_at, name, upc, price) '
+                         'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(retailer, url) DO UPDATE SET '
+                         'fetched_at=excluded.fetched_at, name=excluded.name, upc=excluded.upc, price=excluded.price',
+                         (retailer, url, int(time.time()), name, upc, price))
+        ROWS_WRITTEN.inc(table='product_metadata')
+
+    @QUERY_SECONDS.time(query='get_product_polls')
+    def get_product_polls(self, retailer: str, urls: [str]) -> dict:
+        """Return {url: polled_at} of the retailer's products that have been polled."""
+        polls = {}
+        with self.transaction() as conn:
+            for chunk in _chunks(list(urls), _MAX_VARIABLES - 1):
+                rows = conn.execute('SELECT url, polled_at FROM product_polls '
+                                    'WHERE retailer=? AND url IN ({})'.format(','.join('?' * len(chunk))),
+                                    [retailer] + chunk)
+                polls.update(rows)
+
+        return polls
+
+    @QUERY_SECONDS.time(query='record_product_polls')
+    def record_product_polls(self, retailer: str, urls: [str], polled_at: int) -> None:
+        if not urls:
+            return
+        with self.transaction() as conn:
+            conn.executemany('INSERT INTO product_polls(retailer, url, polled_at) VALUES (?, ?, ?) '
+                             'ON CONFLICT(retailer, url) DO UPDATE SET polled_at=excluded.polled_at',
+                             [(retailer, url, polled_at) for url in urls])
+        ROWS_WRITTEN.inc(len(urls), table='product_polls')
+
+    @QUERY_SECONDS.time(query='get_response_cache')
+    def get_response_cache(self, retailer: str) -> dict:
+        """Return {fingerprint: (etag, last_modified, body_hash)} of the last
+        response to each of the retailer's cached requests.
+        """
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT fingerprint, etag, last_modified, body_hash FROM response_cache '
+                                'WHERE retailer=?', (retailer,))
+            return {fingerprint: (etag, last_modified, body_hash) for fingerprint, etag, last_modified, body_hash in rows}
+
+    @QUERY_SECONDS.time(query='save_response_cache')
+    def save_response_cache(self, retailer: str, entries: dict, fetched_at: int, max_age: int) -> None:
+        """Save {fingerprint: (etag, last_modified, body_hash)} of responses
+        fetched at fetched_at and forget the ones not fetched in max_age
+        seconds.
+        """
+        with self.transaction() as conn:
+            if entries:
+                conn.executemany('INSERT INTO response_cache'
+                                 '(retailer, fingerprint, fetched_at, etag, last_modified, body_hash) '
+                                 'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(retailer, fingerprint) DO UPDATE SET '
+                                 'fetched_at=excluded.fetched_at, etag=excluded.etag, '
+                                 'last_modified=excluded.last_modified, body_hash=excluded.body_hash',
+                                 [(retailer, fingerprint, fetched_at) + entry for fingerprint, entry in entries.items()])
+            conn.execute('DELETE FROM response_cache WHERE retailer=? AND fetched_at<?',
+                         (retailer, fetched_at - max_age))
+        ROWS_WRITTEN.inc(len(entries), table='response_cache')
+
+    @QUERY_SECONDS.time(query='stock_history')
+    def stock_history(self, store_name: str, product_names: [str], since: int) -> dict:
+        """Return {product_name: [(last_updated, location_id, quantity), ...]} of
+        every stock change of the products at the store since the given time,
+        oldest first.
+        """
+        history = {}
+        nocase = self.backend.nocase('name')
+        with self.transaction() as conn:
+            store = conn.execute('SELECT id FROM stores WHERE {}=?'.format(nocase), (_nocase(store_name),)).fetchone()
+            product_ids = {}  # product_id:product_name
+            for chunk in _chunks([_nocase(name) for name in product_names], _MAX_VARIABLES):
+                product_ids.update(conn.execute('SELECT id, name FROM products '
+                                                'WHERE {} IN ({})'.format(nocase, ','.join('?' * len(chunk))), chunk))
+
+        if store is not None and product_ids:
+            for _, last_updated, product_id, _, location_id, quantity, _ in self.stock_changes(
+                    since, store_id=store[0], product_ids=product_ids):
+                history.setdefault(_nocase(product_ids[product_id]), []).append((last_updated, location_id, quantity))
+
+        return {name: history.get(_nocase(name), []) for name in product_names}
+
+    @QUERY_SECONDS.time(query='stock_changes')
+    def stock_changes(self, since: int = None, until: int = None, store_id: int = None,
+                      product_ids=None) -> [tuple]:
+        """Return the (id, last_updated, product_id, store_id, location_id,
+        quantity, price) of every stock change in [since, until), optionally
+        only of a store and of a collection of products, oldest first.
+
+        Reads both the compacted history segments and product_stock.
+        """
+        def wanted(row: tuple) -> bool:
+            return ((since is None or row[1] >= since) and (until is None or row[1] < until)
+                    and (store_id is None or row[3] == store_id)
+                    and (product_ids is None or row[2] in product_ids))
+
+        changes = []
+        for path in history.segment_paths(self.history_dir, since, until):
+            changes.extend(row for row in history.read_rows(path) if wanted(row))
+        compacted_ids = {row[0] for row in changes}
+
+        # Rows of an interrupted compaction can be in both
+        changes.extend(row for row in self.hot_stock_changes(since, until, store_id, product_ids)
+                       if row[0] not in compacted_ids)
+        changes.sort(key=lambda r: (r[1], r[0]))
+        return changes
+
+    @QUERY_SECONDS.time(query='hot_stock_changes')
+    def hot_stock_changes(self, since: int = None, until: int = None, store_id: int = None,
+                          product_ids=None) -> [tuple]:
+        """Return the stock changes of stock_changes that are still in
+        product_stock, in no particular order.
+        """
+        conditions = ['last_updated>=?', 'last_updated<?']
+        params = [since if since is not None else -2 ** 63, until if until is not None else 2 ** 63 - 1]
+        if store_id is not None:
+            conditions.append('store_id=?')
+            params.append(store_id)
+
+        product_chunks = [None] if product_ids is None else _chunks(list(product_ids), _MAX_VARIABLES - len(params))
+        changes = []
+        with self.transaction() as conn:
+            for chunk in product_chunks:
+                product_condition = [] if chunk is None else ['product_id IN ({})'.format(','.join('?' * len(chunk)))]
+                changes.extend(conn.execute('SELECT id, last_updated, product_id, store_id, location_id, quantity, '
+                                            'price FROM product_stock WHERE ' + ' AND '.join(conditions + product_condition),
+                                            params + (chunk or [])))
+        return changes
+
+    @QUERY_SECONDS.time(query='dimension_names')
+    def dimension_names(self) -> (dict, dict, dict):
+        """Return {id: name} of every product, store and store location."""
+        with self.transaction() as conn:
+            return (dict(conn.execute('SELECT id, name FROM products')),
+                    dict(conn.execute('SELECT id, name FROM stores')),
+                    dict(conn.execute('SELECT id, location FROM store_locations')))
+
+    @QUERY_SECONDS.time(query='compact_history')
+    def compact_history(self, hot_for: int) -> int:
+        """Move stock changes from before the month hot_for seconds ago out of
+        the db into history segments. Return how many were moved.
+
+        Rows still referenced by latest_stock stay in the db. Each month is
+        merged with its existing segment and written before its rows are
+        deleted, and merges skip rows already in the segment, so an interrupted
+        compaction is finished by the next one. Stock events from before that
+        month are dropped from the event log.
+        """
+        before = history.month_start(int(time.time()) - hot_for)
+        directory = Path(self.history_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        with self.transaction() as conn:
+            oldest = conn.execute('SELECT min(last_updated) FROM product_stock WHERE last_updated<? '
+                                  'AND id NOT IN (SELECT stock_id FROM latest_stock)', (before,)).fetchone()[0]
+
+        moved = 0
+        start = history.month_start(oldest) if oldest is not None else before
+        while start < before:
+            end = min(before, history.month_start(start + 32 * DAY))
+            with self.transaction() as conn:
+                rows = conn.execute("""
+SELECT id, last_updated, product_id, store_id, location_id, quantity, price FROM product_stock
+WHERE last_updated>=? AND last_updated<? AND id NOT IN (SELECT stock_id FROM latest_stock)""",
+                                    (start, end)).fetchall()
+
+            if rows:
+                history.merge_segment(directory / (history.month(start) + '.seg'), rows)
+                with self.transaction() as conn:
+                    for chunk in _chunks([r[0] for r in rows], _MAX_VARIABLES):
+                        conn.execute('DELETE FROM product_stock WHERE id IN ({})'.format(','.join('?' * len(chunk))),
+                                     chunk)
+                moved += len(rows)
+            start = end
+
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM stock_events WHERE observed_at<?', (before,))
+
+        return moved
+
+    def data_version(self, conn) -> int:
+        """Return a value that changes whenever another connection, of this
+        process or another, commits stock. Commits to other tables, e.g. the
+        crawl caches, leave it unchanged.
+        """
+        with self.transaction(conn):
+            return self.backend.data_version(conn)
+
+    @QUERY_SECONDS.time(query='latest_product_stock')
+    def latest_product_stock(self, conn, limit: int) -> [tuple]:
+        """Return the latest (product_name, store_id, location, quantity, price)
+        of up to limit product locations, least recently updated first.
+        """
+        with self.transaction(conn):
+            return conn.execute("""
+SELECT product_name, store_id, location, quantity, price FROM (
+    SELECT p.name AS product_name, ls.store_id, sl.location, ls.quantity, ls.price, ls.last_updated
+    FROM latest_stock AS ls
+    INNER JOIN store_locations AS sl ON sl.id = ls.location_id
+    INNER JOIN products AS p ON p.id=ls.product_id
+    ORDER BY ls.last_updated DESC
+    LIMIT ?) AS recent
+ORDER BY last_updated""", (limit,)).fetchall()
+
+    @QUERY_SECONDS.time(query='products_in_stock')
+    def products_in_stock(self) -> str:
         """Find all products that are currently in stock."""
 
         s = 'Product Stock Summary:\n'
-        with sqlite3.connect(Dao.DB_FILE) as conn:
-            c = conn.cursor()
-
-            c.execute("""
-SELECT datetime(ps.last_updated, 'unixepoch'), s.name, sl.location, p.name, ps.price, ps.quantity
-FROM product_stock AS ps
-INNER JOIN stores AS s ON s.id=ps.store_id
-INNER JOIN store_locations AS sl ON sl.id = ps.location_id
-INNER JOIN products AS p ON p.id=ps.product_id
-INNER JOIN (
-    SELECT id, max(last_updated)
-    FROM product_stock
-    GROUP BY store_id, location_id, product_id) latest_stock ON latest_stock.id=ps.id
-WHERE ps.quantity != 0
-ORDER BY s.name, sl.location, p.name""")
-
-            for row in c.fetchall():
-                timestamp = row[0]
-                store = row[1]
-                location = row[2]
-                product = row[3]
-                price = row[4]
-                quantity = row[5]
-
-                s += '- [{}] {}, {} - {}: {} @ ${}\n'.format(timestamp, store, location, product, quantity, price)
+        with self.transaction() as conn:
+            rows = conn.execute("""
+SELECT ls.last_updated, s.name, sl.location, p.name, ls.price, ls.quantity
+FROM latest_stock AS ls
+INNER JOIN stores AS s ON s.id=ls.store_id
+INNER JOIN store_locations AS sl ON sl.id = ls.location_id
+INNER JOIN products AS p ON p.id=ls.product_id
+WHERE ls.quantity != 0
+ORDER BY s.name, sl.location, p.name""").fetchall()
+
+        for row in rows:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(row[0]))
+            store = row[1]
+            location = row[2]
+            product = row[3]
+            price = row[4]
+            quantity = row[5]
+
+            s += '- [{}] {}, {} - {}: {} @ ${}\n'.format(timestamp, store, location, product, quantity, price)
 
         return s
@@ -0,0 +1,133 @@
+"""Columnar segments of compacted product_stock history.
+
+Stock changes older than the hot window are moved out of the db into one
+segment file per month, <directory>/YYYY-MM.seg. A segment holds every column
+of product_stock as a zlib compressed array, sorted by (last_updated, id).
+The id and last_updated columns are delta encoded first, which makes them
+compress to almost nothing.
+"""
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import os
+import sys
+import zlib
+
+MAGIC = b'HSSEG1\n'
+
+# (name, array typecode, delta encoded) of the columns of a segment, in
+# product_stock row order
+COLUMNS = (('id', 'q', True),
+           ('last_updated', 'q', True),
+           ('product_id', 'q', False),
+           ('store_id', 'q', False),
+           ('location_id', 'q', False),
+           ('quantity', 'q', False),
+           ('price', 'd', False))
+
+# Stands in for a NULL quantity, NULL prices are stored as NaN
+NULL_QUANTITY = -2 ** 63
+
+
+def month(utc_epoch: int) -> str:
+    """Return the YYYY-MM of the month of the given time."""
+    return datetime.fromtimestamp(utc_epoch, timezone.utc).strftime('%Y-%m')
+
+
+def month_start(utc_epoch: int) -> int:
+    """Return the start of the month of the given time."""
+    d = datetime.fromtimestamp(utc_epoch, timezone.utc)
+    return int(d.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+def _delta_encode(values: array) -> array:
+    return array(values.typecode, [values[0]] + [b - a for a, b in zip(values, values[1:])]) if values else values
+
+
+def _delta_decode(values: array) -> array:
+    total = 0
+    decoded = array(values.typecode)
+    for v in values:
+        total += v
+        decoded.append(total)
+    return decoded
+
+
+def write_segment(path: Path, rows: [tuple]) -> None:
+    """Write product_stock rows to a segment, replacing it atomically."""
+    rows = sorted(rows, key=lambda r: (r[1], r[0]))
+    blobs = []
+    header = {'rows': len(rows), 'columns': []}
+    for i, (name, typecode, delta) in enumerate(COLUMNS):
+        if name == 'quantity':
+            values = array(typecode, (NULL_QUANTITY if r[i] is None else r[i] for r in rows))
+        elif name == 'price':
+            values = array(typecode, (float('nan') if r[i] is None else r[i] for r in rows))
+        else:
+            values = array(typecode, (r[i] for r in rows))
+
+        if delta:
+            values = _delta_encode(values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+
+        blob = zlib.compress(values.tobytes(), 9)
+        header['columns'].append([name, typecode, delta, len(blob)])
+        blobs.append(blob)
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(json.dumps(header).encode() + b'\n')
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_columns(path: Path) -> {str: array}:
+    """Return {column name: array} of a segment. NULL quantities are
+    NULL_QUANTITY and NULL prices are NaN.
+    """
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError('{} is not a history segment'.format(path))
+        header = json.loads(f.readline())
+
+        columns = {}
+        for name, typecode, delta, length in header['columns']:
+            values = array(typecode)
+            values.frombytes(zlib.decompress(f.read(length)))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            columns[name] = _delta_decode(values) if delta else values
+
+    return columns
+
+
+def read_rows(path: Path) -> [tuple]:
+    """Return the product_stock rows of a segment, oldest first."""
+    columns = read_columns(path)
+    rows = []
+    for row in zip(*(columns[name] for name, _, _ in COLUMNS)):
+        quantity, price = row[5], row[6]
+        rows.append(row[:5] + (None if quantity == NULL_QUANTITY else quantity, None if price != price else price))
+    return rows
+
+
+def segment_paths(directory: Path, since: int = None, until: int = None) -> [Path]:
+    """Return the segments that can hold changes in [since, until), oldest
+    first.
+    """
+    first = month(since) if since is not None else ''
+    last = month(until) if until is not None else '9999-99'
+    return sorted(p for p in Path(directory).glob('*.seg') if first <= p.stem <= last)
+
+
+def merge_segment(path: Path, rows: [tuple]) -> None:
+    """Add product_stock rows to a segment, skipping the ones it already has."""
+    existing = read_rows(path) if path.exists() else []
+    existing_ids = {r[0] for r in existing}
+    write_segment(path, existing + [r for r in rows if r[0] not in existing_ids])
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Check PostgresBackend against a local PostgreSQL server.
+
+    DATABASE_URL=postgresql://postgres@localhost/postgres python -m db.postgres_check
+
+Skipped unless DATABASE_URL is a postgresql:// URL. The checks run in a
+scratch schema that is dropped afterwards, so any database the user may
+create schemas in will do. They cover concurrent migrations taking turns on
+the advisory lock, stock round trips through Dao, LISTEN/NOTIFY stock
+versions, stock events of overlapping writers and read-only connections.
+"""
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import multiprocessing
+import os
+import sys
+import threading
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from db.backends import POSTGRES_MIGRATIONS, PostgresBackend  # noqa: E402
+from db.dao import Dao  # noqa: E402
+
+
+def schema_url(url: str, schema: str) -> str:
+    """Return url with schema first in the search_path of its connections."""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [('options', '-csearch_path={}'.format(schema))]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _migrate(url: str):
+    PostgresBackend(url).migrate()
+
+
+def check_migrations(url: str):
+    # Processes starting at once wait for each other's migrations
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_migrate, args=(url,)) for _ in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert all(p.exitcode == 0 for p in processes), [p.exitcode for p in processes]
+
+    conn = PostgresBackend(url).connect()
+    try:
+        assert conn.execute('SELECT version FROM schema_version').fetchall() == [(len(POSTGRES_MIGRATIONS),)]
+    finally:
+        conn.close()
+
+
+def check_stock(dao: Dao):
+    store = dao.get_store_id('Walmart')
+    assert dao.get_store_id('WALMART') == store, 'store names are case insensitive'
+
+    conn = dao.connect()
+    try:
+        assert dao.record_latest_product_stock_batch(conn, [
+            (1, 'ps5', store, 'Toronto', 2, 499.0),
+            (2, 'ps5', store, 'Toronto', 2, 499.0),
+            (3, 'PS5', store, 'toronto', 0, 499.0),
+        ]) == [True, False, True]
+        assert [row[5] for row in dao.stock_changes(store_id=store)] == [2, 0]
+        assert [row[3:] for row in dao.latest_product_stock(conn, 10)] == [(0, 499.0)]
+    finally:
+        conn.close()
+
+
+def check_notifications(dao: Dao):
+    store = dao.get_store_id('Walmart')
+    listener, writer = dao.connect(), dao.connect()
+    try:
+        version = dao.data_version(listener)
+        dao.record_latest_product_stock_batch(listener, [(10, 'own', store, 'Toronto', 1, 1.0)])
+        assert dao.data_version(listener) == version, "a connection's own stock doesn't change its version"
+
+        dao.save_product_metadata('walmart', 'https://example.com/p', 'p')
+        assert dao.data_version(listener) == version, 'only stock changes the version'
+
+        dao.record_latest_product_stock_batch(writer, [(11, 'other', store, 'Toronto', 1, 1.0)])
+        assert dao.data_version(listener) != version, 'stock of other connections changes the version'
+    finally:
+        listener.close()
+        writer.close()
+
+
+def check_stock_events(dao: Dao):
+    store = dao.get_store_id('Walmart')
+    products = ['event {}'.format(i) for i in range(100)]
+    conn = dao.connect()
+    try:
+        dao.record_latest_product_stock_batch(conn, [(20, p, store, 'Toronto', 0, 1.0) for p in products])
+    finally:
+        conn.close()
+    with dao.transaction() as conn:
+        start = conn.execute('SELECT COALESCE(MAX(id), 0) FROM stock_events').fetchone()[0]
+
+    # Both writers read the stock before either records the restocks
+    barrier = threading.Barrier(2)
+    latest_stock = Dao._latest_stock
+
+    def overlapping(conn, stock_keys):
+        latest = latest_stock(conn, stock_keys)
+        barrier.wait()
+        return latest
+
+    def sweep(observed_at: int):
+        conn = dao.connect()
+        try:
+            dao.record_latest_product_stock_batch(conn, [(observed_at, p, store, 'Toronto', 3, 1.0) for p in products])
+        finally:
+            conn.close()
+
+    Dao._latest_stock = staticmethod(overlapping)
+    try:
+        threads = [threading.Thread(target=sweep, args=(t,)) for t in (21, 22)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        Dao._latest_stock = staticmethod(latest_stock)
+
+    events = dao.stock_events(start, 1000)
+    assert len(events) == len(products), 'overlapping writers append one event per change'
+    assert [e.offset for e in events] == sorted(e.offset for e in events)
+    assert {e.kind for e in events} == {'restock'}
+
+
+def check_read_only(url: str):
+    dao = Dao(PostgresBackend(url, read_only=True))
+    try:
+        dao.get_store_id('Best Buy')
+    except Exception as e:
+        assert 'read-only' in str(e), e
+    else:
+        raise AssertionError('read-only connections must not write')
+
+
+def main():
+    url = os.environ.get('DATABASE_URL', '')
+    if urlsplit(url).scheme not in ('postgres', 'postgresql'):
+        print('skipped: set DATABASE_URL to a postgresql:// URL to check PostgresBackend')
+        return
+
+    schema = 'hyper_scraper_check_' + uuid.uuid4().hex[:8]
+    admin = PostgresBackend(url).connect()
+    admin.execute('CREATE SCHEMA ' + schema)
+    admin.commit()
+    try:
+        scratch = schema_url(url, schema)
+        check_migrations(scratch)
+        dao = Dao(PostgresBackend(scratch))
+        for check in (check_stock, check_notifications, check_stock_events):
+            check(dao)
+            print('ok', check.__name__)
+        dao.pool.close()
+        check_read_only(scratch)
+        print('ok check_read_only')
+    finally:
+        admin.execute('DROP SCHEMA {} CASCADE'.format(schema))
+        admin.commit()
+        admin.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+from time import monotonic
+import logging
+import random
+import signal
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall
+from db.dao import Dao
+from hyper_scraper.watchlist import load_watchlist
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlScheduler:
+    """Re-crawls each retailer on its own interval within one reactor.
+
+    The next crawl of a retailer is scheduled once its current crawl
+    finishes, interval seconds (plus or minus jitter) after it started, so
+    two crawls of the same spider never overlap.
+    """
+
+    def __init__(self, runner: CrawlerRunner, intervals: {str: float}, jitter: float):
+        self.runner = runner
+        self.intervals = intervals  # retailer:seconds
+        self.jitter = jitter
+        self.calls = {}  # retailer:IDelayedCall of the next crawl
+        self.stopping = False
+
+    def start(self):
+        # Spread the first crawls out rather than starting them all at once
+        for retailer, interval in self.intervals.items():
+            self.calls[retailer] = reactor.callLater(random.uniform(0, self.jitter * interval), self._crawl, retailer)
+
+    def _crawl(self, retailer: str):
+        self.calls.pop(retailer, None)
+        if self.stopping:
+            return
+
+        started = monotonic()
+        d = self.runner.crawl(retailer)
+        d.addErrback(lambda f: logger.error('%s crawl failed: %s', retailer, f.getTraceback()))
+        d.addBoth(lambda _: self._schedule(retailer, started))
+
+    def _schedule(self, retailer: str, started: float):
+        if self.stopping:
+            return
+
+        interval = self.intervals[retailer] * (1 + random.uniform(-self.jitter, self.jitter))
+        delay = max(0.0, interval - (monotonic() - started))
+        self.calls[retailer] = reactor.callLater(delay, self._crawl, retailer)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """Cancel scheduled crawls and gracefully stop the running ones."""
+        self.stopping = True
+        for call in self.calls.values():
+            call.cancel()
+        self.calls.clear()
+
+        yield self.runner.stop()
+        yield self.runner.join()
+
+
+def crawl_intervals(settings) -> {str: float}:
+    """Return the crawl interval of every retailer in the watchlist."""
+    default = settings.getfloat('DAEMON_CRAWL_INTERVAL')
+    overrides = settings.getdict('DAEMON_CRAWL_INTERVALS')
+    return {retailer: float(overrides.get(retailer, default))
+            for retailer in load_watchlist(settings.get('WATCHLIST_FILE'))}
+
+
+def compact_history(dao: Dao, hot_for: int):
+    """Compact stock history in a thread so crawls keep running."""
+    d = threads.deferToThread(dao.compact_history, hot_for)
+    d.addCallback(lambda moved: logger.info('Compacted %d stock changes into history segments', moved))
+    d.addErrback(lambda f: logger.error('History compaction failed: %s', f.getTraceback()))
+    return d
+
+
+def run_daemon(settings):
+    """Crawl every retailer in the watchlist on its interval until SIGTERM or
+    SIGINT, then let running crawls finish closing and exit. Stock history is
+    compacted every HISTORY_COMPACT_INTERVAL seconds.
+    """
+    configure_logging(settings)
+    scheduler = CrawlScheduler(CrawlerRunner(settings), crawl_intervals(settings),
+                               settings.getfloat('DAEMON_CRAWL_JITTER'))
+
+    compaction = LoopingCall(compact_history, Dao.from_settings(settings), settings.getint('HISTORY_HOT_FOR'))
+
+    @defer.inlineCallbacks
+    def shutdown():
+        if scheduler.stopping:
+            return
+        logger.info('Shutting down, waiting for running crawls to close')
+        if compaction.running:
+            compaction.stop()
+        yield scheduler.stop()
+        reactor.stop()
+
+    def on_signal(signum, frame):
+        reactor.callFromThread(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    reactor.callWhenRunning(scheduler.start)
+    reactor.callWhenRunning(compaction.start, settings.getfloat('HISTORY_COMPACT_INTERVAL'))
+    reactor.run(installSignalHandlers=False)
@@ -0,0 +1,49 @@
+"""Decoding of JSON response bodies straight from the body bytes.
+
+orjson or simdjson (pysimdjson) are used when installed, stdlib json
+otherwise. Callbacks that only read a few fields of every object of an
+array use records(). With simdjson the body is parsed lazily, so only those
+fields are ever turned into Python objects, not the rest of each object.
+"""
+from operator import itemgetter
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+def loads(data):
+    """Decode a whole JSON document of bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if simdjson is not None:
+        return simdjson.loads(data)
+    return json.loads(data)
+
+
+def records(body, array: str, fields: (str,)) -> [tuple]:
+    """Return a tuple of the given fields of every object of the array under
+    the key array of the top level object of body, bytes or str.
+
+    Fields holding arrays or objects are read-only lazy views of them with
+    simdjson, and lists and dicts otherwise. Raises KeyError for a missing
+    array or field.
+    """
+    if simdjson is not None:
+        # A parser's views are only valid until it parses again, so every
+        # body gets its own
+        objects = simdjson.Parser().parse(body)[array]
+    else:
+        objects = loads(body)[array]
+
+    get = itemgetter(*fields)
+    if len(fields) == 1:
+        return [(get(obj),) for obj in objects]
+    return list(map(get, objects))
@@ -0,0 +1,79 @@
+"""Exporters writing stock observations to files in batches.
+
+Exporters are picked by the suffix of the export path from STOCK_EXPORTERS,
+e.g. .jsonl or .csv. A further .gz, .bz2 or .xz suffix compresses the file.
+An exporter is a class taking the open binary file, with an export(items)
+method writing a batch of StockObservations and a finish() method called
+before the file is closed.
+"""
+from dataclasses import fields
+from operator import attrgetter
+from pathlib import Path
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+from hyper_scraper.items import StockObservation
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FIELDS = tuple(f.name for f in fields(StockObservation))
+
+COMPRESSORS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+_values = attrgetter(*FIELDS)
+
+
+def open_export(path: Path):
+    """Open path for writing in binary, compressed as its suffix says."""
+    return COMPRESSORS.get(path.suffix.lower(), open)(path, 'wb')
+
+
+def export_format(path: Path) -> str:
+    """Return the format of an export path, e.g. csv for stock.csv.gz."""
+    suffixes = [s.lower() for s in path.suffixes]
+    if suffixes and suffixes[-1] in COMPRESSORS:
+        suffixes.pop()
+    return suffixes[-1][1:] if suffixes else ''
+
+
+class JsonLinesExporter(object):
+    """One JSON object per observation and line."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def export(self, items: [StockObservation]):
+        if orjson is not None:
+            # orjson serializes dataclasses itself
+            lines = [orjson.dumps(item) for item in items]
+        else:
+            lines = [json.dumps(dict(zip(FIELDS, _values(item)))).encode() for item in items]
+        lines.append(b'')
+        self.file.write(b'\n'.join(lines))
+
+    def finish(self):
+        pass
+
+
+class CsvExporter(object):
+    """A header row of the StockObservation fields, then a row per
+    observation. None is written as an empty field.
+    """
+
+    def __init__(self, file):
+        self.text = io.TextIOWrapper(file, encoding='utf-8', newline='', write_through=True)
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(FIELDS)
+
+    def export(self, items: [StockObservation]):
+        self.writer.writerows(map(_values, items))
+
+    def finish(self):
+        self.text.flush()
+        self.text.detach()  # the pipeline closes the file
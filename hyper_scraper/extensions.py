@@ -0,0 +1,101 @@
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from db.dao import Dao
+from hyper_scraper.middlewares import callback_timed
+from metrics import prometheus
+from notifs.events import EventDispatcher
+
+REQUEST_SECONDS = prometheus.histogram('hyper_scraper_request_seconds', 'Download latency of responses',
+                                       ('retailer', 'endpoint'))
+RESPONSES = prometheus.counter('hyper_scraper_responses_total', 'Responses received',
+                               ('retailer', 'endpoint', 'status'))
+PARSE_SECONDS = prometheus.histogram('hyper_scraper_parse_seconds', 'Time spent in spider callbacks',
+                                     ('retailer', 'callback'))
+CRAWL_SECONDS = prometheus.histogram('hyper_scraper_crawl_seconds', 'Duration of finished crawls', ('retailer',),
+                                     buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+CRAWLS = prometheus.counter('hyper_scraper_crawls_total', 'Finished crawls', ('retailer', 'finish_reason'))
+ERRORS = prometheus.counter('hyper_scraper_errors_total', 'Errors during crawls', ('retailer', 'source'))
+CRAWL_STATS = prometheus.gauge('hyper_scraper_last_crawl_stat', 'Numeric Scrapy stats of the last crawl',
+                               ('retailer', 'stat'))
+
+
+class MetricsExtension(object):
+    """Feeds request, parse and crawl metrics from Scrapy's signals and stats
+    collector, and exports every metric over HTTP on METRICS_PORT and/or to
+    the METRICS_TEXTFILE textfile collector file after each crawl.
+
+    Requests are labelled by the endpoint of their callback, since every
+    callback parses the responses of a single retailer endpoint. They are
+    counted as downloaded, before downloader middlewares drop any.
+    """
+
+    def __init__(self, crawler, port: int, textfile: str):
+        self.crawler = crawler
+        self.port = port
+        self.textfile = textfile
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        port = crawler.settings.getint('METRICS_PORT')
+        textfile = crawler.settings.get('METRICS_TEXTFILE')
+        if not port and not textfile:
+            raise NotConfigured
+
+        s = cls(crawler, port, textfile)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(s.callback_timed, signal=callback_timed)
+        return s
+
+    def spider_opened(self, spider):
+        if self.port:
+            prometheus.serve(self.port)
+
+    def callback_timed(self, callback, seconds, spider):
+        PARSE_SECONDS.observe(seconds, retailer=spider.name, callback=callback)
+
+    def response_downloaded(self, response, request, spider):
+        endpoint = getattr(request.callback, '__name__', 'none')
+        RESPONSES.inc(retailer=spider.name, endpoint=endpoint, status=response.status)
+        if 'download_latency' in request.meta:
+            REQUEST_SECONDS.observe(request.meta['download_latency'], retailer=spider.name, endpoint=endpoint)
+
+    def spider_closed(self, spider, reason):
+        stats = self.crawler.stats.get_stats()
+        CRAWLS.inc(retailer=spider.name, finish_reason=reason)
+        if 'elapsed_time_seconds' in stats:
+            CRAWL_SECONDS.observe(stats['elapsed_time_seconds'], retailer=spider.name)
+
+        ERRORS.inc(stats.get('log_count/ERROR', 0), retailer=spider.name, source='log')
+        ERRORS.inc(stats.get('downloader/exception_count', 0), retailer=spider.name, source='download')
+        ERRORS.inc(sum(v for k, v in stats.items() if k.startswith('spider_exceptions/')),
+                   retailer=spider.name, source='spider')
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                CRAWL_STATS.set(value, retailer=spider.name, stat=stat)
+
+        if self.textfile:
+            prometheus.write_textfile(self.textfile)
+
+
+class EventDispatchExtension(object):
+    """Delivers the db's stock event log to the EVENT_SUBSCRIBERS from
+    background threads of the crawling process, see notifs.events.
+
+    One dispatcher serves every crawl of the process, e.g. of main.py daemon,
+    and catches up with the log at exit.
+    """
+    _dispatcher = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getdict('EVENT_SUBSCRIBERS'):
+            raise NotConfigured
+
+        if cls._dispatcher is None:
+            cls._dispatcher = EventDispatcher.from_settings(Dao.from_settings(crawler.settings), crawler.settings)
+            cls._dispatcher.start()
+        if not cls._dispatcher.subscribers:
+            raise NotConfigured
+        return cls()
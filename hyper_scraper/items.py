@@ -5,10 +5,19 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
-import scrapy
+from dataclasses import dataclass
 
 
-class ProductScraperItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+@dataclass
+class StockObservation:
+    """A single stock observation of a product at a store location."""
+    __slots__ = ('observed_at', 'retailer', 'product_name', 'sku', 'location', 'quantity', 'price', 'status')
+
+    observed_at: int  # utc epoch
+    retailer: str  # also the store name in the db
+    product_name: str
+    sku: str  # the retailer's product ID, the UPC for Walmart
+    location: str
+    quantity: int
+    price: float
+    status: str  # availability status the quantity was estimated from, None if the retailer gives quantities
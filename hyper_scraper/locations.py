@@ -0,0 +1,48 @@
+"""Store locations found during a crawl, shared by the spider's callbacks.
+
+Location lookups return a whole JSON object per store, of which only the ID,
+name and address are needed. Requests refer to stores by location ID and
+callbacks look them up in the crawl's LocationRegistry, so requests stay the
+same size however many stores are in scope.
+"""
+
+
+class StoreLocation(object):
+    __slots__ = ('id', 'name', 'address', 'postal_code')
+
+    def __init__(self, id: str, name: str, address: str, postal_code: str):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.postal_code = postal_code  # of the lookup that found it
+
+    def __repr__(self):
+        return 'StoreLocation({!r}, {!r}, {!r}, {!r})'.format(self.id, self.name, self.address, self.postal_code)
+
+
+class LocationRegistry(object):
+    """Store locations by ID, in the order they were first found."""
+
+    def __init__(self):
+        self._locations = {}  # id:StoreLocation
+
+    def add(self, id: str, name: str, address: str, postal_code: str) -> StoreLocation:
+        """Register a location unless already found near another postal
+        code, and return the registered location.
+        """
+        location = self._locations.get(id)
+        if location is None:
+            location = self._locations[id] = StoreLocation(id, name, address, postal_code)
+        return location
+
+    def ids(self) -> [str]:
+        return list(self._locations)
+
+    def __getitem__(self, id: str) -> StoreLocation:
+        return self._locations[id]
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._locations
+
+    def __len__(self) -> int:
+        return len(self._locations)
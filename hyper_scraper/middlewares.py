@@ -5,7 +5,23 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+from collections import deque
+from time import monotonic, perf_counter, time
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from db.dao import Dao
+from metrics import prometheus
+import functools
+import hashlib
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_CONCURRENCY = prometheus.gauge('hyper_scraper_endpoint_concurrency', 'Concurrency limit of endpoints',
+                                        ('retailer', 'endpoint'))
+CIRCUIT_OPENS = prometheus.counter('hyper_scraper_circuit_opens_total', 'Times the circuit of an endpoint opened',
+                                   ('retailer', 'endpoint'))
 
 
 class ProductScraperSpiderMiddleware(object):
@@ -56,6 +72,68 @@ class ProductScraperSpiderMiddleware(object):
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+# Sent by CallbackTimingMiddleware after each callback, with the callback's
+# name, the seconds spent in it and the spider
+callback_timed = object()
+
+
+class CallbackTimingMiddleware(object):
+    """Times the callback of every response and sends callback_timed.
+
+    The spider's methods are left as they are, so the requests it queues
+    still refer to them, as JOBDIR queues need. Only the request of a
+    downloaded response, which is never queued again, has its callback
+    swapped for a timed one just before Scrapy calls it. Both the call and
+    the iteration of a generator result are timed, but not the processing of
+    what it yields.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        # callback function:timed callback. Reused, Scrapy caches per callback
+        # whether it is a generator with a return value.
+        self.timed = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_input(self, response, spider):
+        request = response.request
+        func = getattr(request.callback, '__func__', None)
+        if func is not None and request.callback.__self__ is spider:
+            if func not in self.timed:
+                self.timed[func] = functools.wraps(func)(functools.partial(self._call, func, spider))
+            request.callback = self.timed[func]
+        return None
+
+    def _call(self, func, spider, *args, **kwargs):
+        start = perf_counter()
+        result = func(spider, *args, **kwargs)
+        elapsed = perf_counter() - start
+        if result is None:
+            self._observe(func.__name__, elapsed, spider)
+            return None
+        return self._iterate(func.__name__, result, elapsed, spider)
+
+    def _iterate(self, name: str, result, elapsed: float, spider):
+        it = iter(result)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += perf_counter() - start
+            yield item
+
+        self._observe(name, elapsed, spider)
+
+    def _observe(self, name: str, seconds: float, spider):
+        self.crawler.signals.send_catch_log(signal=callback_timed, callback=name, seconds=seconds, spider=spider)
+
+
 class ProductScraperDownloaderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -101,3 +179,343 @@ class ProductScraperDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class UnchangedResponse(IgnoreRequest):
+    """Raised by UnchangedResponseMiddleware to drop a response that is the
+    same as the last crawl's. Errbacks get it like any IgnoreRequest.
+    """
+
+
+class UnchangedResponseMiddleware(object):
+    """Drops responses to requests with meta['skip_unchanged'] set when they
+    are the same as the last crawl's, so the spider doesn't parse them.
+
+    The ETag and Last-Modified of the last response are sent back as
+    conditional headers, and a 304 Not Modified answer is dropped. Retailers
+    that don't support them answer in full, so the body is hashed and dropped
+    if it matches the last body of the same request fingerprint. Responses
+    are remembered across crawls in the db, per retailer.
+
+    A crawl whose callbacks or item pipelines failed, or whose stock writes
+    failed (the stock_writer/flush_errors stat), may not have recorded what
+    its responses said. Its responses are not remembered, so the next crawl
+    parses them again.
+    """
+
+    def __init__(self, crawler, dao: Dao, max_age: int):
+        self.crawler = crawler
+        self.dao = dao
+        self.max_age = max_age
+        self.cache = {}  # fingerprint:(etag, last_modified, body_hash)
+        self.seen = {}  # fingerprint:(etag, last_modified, body_hash) of this crawl
+        self.failed = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler, Dao.from_settings(crawler.settings), crawler.settings.getint('RESPONSE_CACHE_MAX_AGE'))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.crawl_failed, signal=signals.spider_error)
+        crawler.signals.connect(s.crawl_failed, signal=signals.item_error)
+        return s
+
+    def spider_opened(self, spider):
+        self.cache = self.dao.get_response_cache(spider.retailer)
+        self.failed = False
+
+    def crawl_failed(self, failure, response, spider, item=None):
+        self.failed = True
+
+    def spider_closed(self, spider):
+        # Item pipelines are closed, and their last flush done, before this
+        if self.failed or self.crawler.stats.get_value('stock_writer/flush_errors'):
+            spider.logger.warning('Not remembering the responses of a crawl that failed to record some items')
+            return
+        self.dao.save_response_cache(spider.retailer, self.seen, int(time()), self.max_age)
+
+    def _fingerprint(self, request) -> str:
+        return self.crawler.request_fingerprinter.fingerprint(request).hex()
+
+    def process_request(self, request, spider):
+        if not request.meta.get('skip_unchanged'):
+            return None
+
+        cached = self.cache.get(self._fingerprint(request))
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                request.headers.setdefault('If-None-Match', etag)
+            if last_modified:
+                request.headers.setdefault('If-Modified-Since', last_modified)
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('skip_unchanged'):
+            return response
+
+        fingerprint = self._fingerprint(request)
+        cached = self.cache.get(fingerprint)
+        if response.status == 304 and cached is not None:
+            self.seen[fingerprint] = cached
+            self.crawler.stats.inc_value('unchanged_response/not_modified')
+            raise UnchangedResponse('Not modified since the last crawl')
+        if response.status != 200:
+            return response
+
+        body_hash = hashlib.blake2b(response.body, digest_size=16).hexdigest()
+        self.seen[fingerprint] = (response.headers.get('ETag', b'').decode('latin-1') or None,
+                                  response.headers.get('Last-Modified', b'').decode('latin-1') or None,
+                                  body_hash)
+        if cached is not None and cached[2] == body_hash:
+            self.crawler.stats.inc_value('unchanged_response/same_body')
+            raise UnchangedResponse('Same body as the last crawl')
+        return response
+
+
+class EndpointLimit(object):
+    """AIMD concurrency limit and circuit breaker of one retailer endpoint.
+
+    Every response within tolerance times the baseline latency (the lowest the
+    moving average latency has been lately) raises the limit by 1/limit, so
+    by about one per round of requests. Slower responses and failures halve
+    it, at most once per average latency, so a burst of them counts once.
+
+    The circuit opens when at least failure_rate of the last window outcomes
+    failed, counting from min_requests outcomes. Requests are then refused
+    for cooldown seconds, or as long as a 429 said to retry after, until a
+    single probe request is let through. Its success closes the circuit with
+    the limit back at min_concurrency, its failure opens it again for twice
+    as long, up to max_cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, concurrency: int, min_concurrency: int, max_concurrency: int, tolerance: float,
+                 window: int, min_requests: int, failure_rate: float, cooldown: float, max_cooldown: float):
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.tolerance = tolerance
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.latency = None  # moving average of successful responses
+        self.baseline = None
+        self.last_decrease = float('-inf')
+        self.outcomes = deque(maxlen=window)  # whether each request failed
+
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.open_for = cooldown
+        self.probed_at = None  # of the probe in flight
+
+    def allow(self, now: float) -> bool:
+        """Return whether a request may be sent now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and now - self.opened_at >= self.open_for:
+            self.state = self.HALF_OPEN
+            self.probed_at = None
+        # A probe that never got an answer doesn't hold the circuit open
+        if self.state == self.HALF_OPEN and (self.probed_at is None or now - self.probed_at >= self.open_for):
+            self.probed_at = now
+            return True
+        return False
+
+    def succeeded(self, now: float, latency: float = None):
+        if self.state == self.OPEN:
+            return  # sent before the circuit opened
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            self.outcomes.clear()
+            self.open_for = self.cooldown
+            self.limit = float(self.min_concurrency)
+
+        self.outcomes.append(False)
+        if latency is None:
+            return
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency += 0.2 * (latency - self.latency)
+            # Follows the average down at once, and up slowly in case the
+            # endpoint got slower for good
+            self.baseline = min(self.latency, self.baseline + 0.01 * (self.latency - self.baseline))
+
+        if self.latency > self.tolerance * self.baseline:
+            self._decrease(now)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def failed(self, now: float, retry_after: float = None) -> bool:
+        """Record a failed request. Return whether it opened the circuit."""
+        if self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN:
+            self._open(now, min(self.max_cooldown, self.open_for * 2), retry_after)
+            return True
+
+        self.outcomes.append(True)
+        self._decrease(now)
+        failures = sum(self.outcomes)
+        if len(self.outcomes) >= self.min_requests and failures >= self.failure_rate * len(self.outcomes):
+            self._open(now, self.cooldown, retry_after)
+            return True
+        return False
+
+    def _decrease(self, now: float):
+        if now - self.last_decrease >= (self.latency or 0):
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.last_decrease = now
+
+    def _open(self, now: float, open_for: float, retry_after: float = None):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.open_for = max(open_for, min(retry_after or 0, self.max_cooldown))
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(self.limit))
+
+
+def _endpoint(request) -> str:
+    """Return the spider callback of the request, None if not a parse*
+    callback (e.g. robots.txt).
+    """
+    name = getattr(request.callback, '__name__', '')
+    return name if name.startswith('parse') else None
+
+
+def _retry_after(response) -> float:
+    try:
+        return float(response.headers.get('Retry-After', b''))
+    except ValueError:
+        return None  # missing, or an HTTP date
+
+
+class EndpointThrottleMiddleware(object):
+    """Throttles the requests of every retailer endpoint separately, so a
+    slow or failing endpoint doesn't hold back the others.
+
+    Each parse* callback parses the responses of a single retailer endpoint,
+    so the requests of a callback get their own download slot, whose
+    concurrency is set by the endpoint's EndpointLimit. Failures are download
+    errors and RETRY_HTTP_CODES responses. While an endpoint's circuit is
+    open its requests are refused, including those already waiting in its
+    download slot.
+
+    Limits outlive crawls, so every crawl of a `main.py daemon` starts from
+    what the last one learned, and a broken endpoint stays refused until its
+    cooldown is over.
+    """
+
+    _limits = {}  # (retailer, endpoint):EndpointLimit
+
+    def __init__(self, crawler, new_limit, failure_codes: {int}):
+        self.crawler = crawler
+        self.new_limit = new_limit
+        self.failure_codes = failure_codes
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ENDPOINT_THROTTLE_ENABLED'):
+            raise NotConfigured
+
+        def new_limit() -> EndpointLimit:
+            return EndpointLimit(settings.getint('ENDPOINT_THROTTLE_START_CONCURRENCY'),
+                                 settings.getint('ENDPOINT_THROTTLE_MIN_CONCURRENCY'),
+                                 settings.getint('ENDPOINT_THROTTLE_MAX_CONCURRENCY'),
+                                 settings.getfloat('ENDPOINT_THROTTLE_LATENCY_TOLERANCE'),
+                                 settings.getint('ENDPOINT_BREAKER_WINDOW'),
+                                 settings.getint('ENDPOINT_BREAKER_MIN_REQUESTS'),
+                                 settings.getfloat('ENDPOINT_BREAKER_FAILURE_RATE'),
+                                 settings.getfloat('ENDPOINT_BREAKER_COOLDOWN'),
+                                 settings.getfloat('ENDPOINT_BREAKER_MAX_COOLDOWN'))
+
+        s = cls(crawler, new_limit, {int(code) for code in settings.getlist('RETRY_HTTP_CODES')})
+        crawler.signals.connect(s.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def _limit(self, request, spider) -> (str, EndpointLimit):
+        endpoint = _endpoint(request)
+        if endpoint is None:
+            return None, None
+        limit = self._limits.get((spider.name, endpoint))
+        if limit is None:
+            limit = self._limits[(spider.name, endpoint)] = self.new_limit()
+        return endpoint, limit
+
+    def _slot(self, request):
+        return self.crawler.engine.downloader.slots.get(request.meta.get('download_slot'))
+
+    def process_request(self, request, spider):
+        endpoint, limit = self._limit(request, spider)
+        if limit is None:
+            return None
+
+        if not limit.allow(monotonic()):
+            self.crawler.stats.inc_value('endpoint_throttle/{}/refused'.format(endpoint))
+            raise IgnoreRequest('The circuit of endpoint {} is open'.format(endpoint))
+        request.meta['download_slot'] = '{} {}'.format(spider.name, endpoint)
+        return None
+
+    def request_reached_downloader(self, request, spider):
+        # The request's slot exists from now on
+        _, limit = self._limit(request, spider)
+        slot = self._slot(request)
+        if limit is not None and slot is not None:
+            slot.concurrency = limit.concurrency
+
+    def process_response(self, request, response, spider):
+        endpoint, limit = self._limit(request, spider)
+        if limit is None:
+            return response
+
+        if response.status in self.failure_codes:
+            self._failed(request, spider, endpoint, limit, _retry_after(response))
+        else:
+            limit.succeeded(monotonic(), request.meta.get('download_latency'))
+            self._update(request, spider, endpoint, limit)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        endpoint, limit = self._limit(request, spider)
+        if limit is not None and not isinstance(exception, IgnoreRequest):
+            self._failed(request, spider, endpoint, limit)
+        return None
+
+    def _failed(self, request, spider, endpoint: str, limit: EndpointLimit, retry_after: float = None):
+        if limit.failed(monotonic(), retry_after):
+            logger.warning('Opened the circuit of %s endpoint %s for %.0fs after %d failures out of %d requests',
+                           spider.name, endpoint, limit.open_for, sum(limit.outcomes), len(limit.outcomes),
+                           extra={'spider': spider})
+            self.crawler.stats.inc_value('endpoint_throttle/{}/circuit_opened'.format(endpoint))
+            CIRCUIT_OPENS.inc(retailer=spider.name, endpoint=endpoint)
+
+            # Fail the requests waiting for the slot now rather than when
+            # they time out
+            slot = self._slot(request)
+            waiting = list(slot.queue) if slot is not None else []
+            if slot is not None:
+                slot.queue.clear()
+            for _, deferred in waiting:
+                self.crawler.stats.inc_value('endpoint_throttle/{}/refused'.format(endpoint))
+                deferred.errback(IgnoreRequest('The circuit of endpoint {} is open'.format(endpoint)))
+        self._update(request, spider, endpoint, limit)
+
+    def _update(self, request, spider, endpoint: str, limit: EndpointLimit):
+        slot = self._slot(request)
+        if slot is not None:
+            slot.concurrency = limit.concurrency
+        ENDPOINT_CONCURRENCY.set(limit.concurrency, retailer=spider.name, endpoint=endpoint)
+        self.crawler.stats.max_value('endpoint_throttle/{}/max_concurrency'.format(endpoint), limit.concurrency)
+
+    def spider_closed(self, spider):
+        for (retailer, endpoint), limit in self._limits.items():
+            if retailer == spider.name:
+                self.crawler.stats.set_value('endpoint_throttle/{}/concurrency'.format(endpoint), limit.concurrency)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Check the stock pipeline, from spider callbacks to the db, against a
+scratch sqlite db.
+
+    python -m hyper_scraper.pipeline_check
+
+The checks cover product pages without a name and stock writes that fail.
+"""
+from scrapy.exceptions import DropItem
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.utils.test import get_crawler
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from db.dao import Dao  # noqa: E402
+from hyper_scraper.items import StockObservation  # noqa: E402
+from hyper_scraper.locations import LocationRegistry  # noqa: E402
+from hyper_scraper.pipelines import StockWriterPipeline  # noqa: E402
+from hyper_scraper.spiders.bestbuy_spider import BestbuySpider  # noqa: E402
+
+PRODUCT_PAGE = '''<html><body>
+<div class="x-product-detail-page">{}</div>
+<meta itemProp="price" content="399.99">
+</body></html>'''
+
+
+def open_crawl(settings: dict):
+    """Return a Best Buy spider and a StockWriterPipeline open on it, as
+    start_requests and the engine would leave them.
+    """
+    crawler = get_crawler(BestbuySpider, settings)
+    spider = BestbuySpider.from_crawler(crawler)
+    spider.dao = Dao.from_settings(crawler.settings)
+    spider.dao.setup_db()
+    spider.observed_at = 1000
+    spider.locations = LocationRegistry()
+    spider.locations.add('937', 'Burlington', '1200 Brant St, Burlington', 'L7P')
+    spider.products = {}
+    spider.product_urls = {}
+    spider.poller = None
+
+    StockWriterPipeline._conn = StockWriterPipeline._cache = None
+    pipeline = StockWriterPipeline.from_crawler(crawler)
+    pipeline.open_spider(spider)
+    return spider, pipeline
+
+
+def product_page(spider, sku: str, title: str):
+    url = 'https://www.bestbuy.ca/en-ca/product/p/' + sku
+    request = Request(url, meta={'url': url, 'sku': sku})
+    spider.parse_product_page(HtmlResponse(url, body=PRODUCT_PAGE.format(title).encode(), request=request))
+
+
+def available_stock(spider, skus: [str]) -> [StockObservation]:
+    body = json.dumps({'availabilities': [
+        {'sku': sku, 'pickup': {'status': 'InStock', 'locations': [{'locationKey': '937', 'quantityOnHand': 3}]}}
+        for sku in skus]})
+    url = 'https://www.bestbuy.ca/availability'
+    request = Request(url, meta={'skus': skus})
+    return list(spider.parse_available_stock(TextResponse(url, body=body.encode(), request=request)))
+
+
+def stock_rows(dao: Dao) -> list:
+    with dao.transaction() as conn:
+        return conn.execute('SELECT p.name, s.quantity FROM product_stock s '
+                            'JOIN products p ON p.id = s.product_id ORDER BY p.name').fetchall()
+
+
+def check_nameless_product(settings: dict):
+    spider, pipeline = open_crawl(settings)
+    product_page(spider, '1', '<h1>Switch</h1>')
+    product_page(spider, '2', '')  # no <h1>
+    assert list(spider.products) == ['1'], 'products without a name are skipped'
+    assert spider.crawler.stats.get_value('product_metadata/incomplete') == 1
+
+    for item in available_stock(spider, list(spider.products)):
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+    assert stock_rows(spider.dao) == [('Switch', 3)]
+
+    nameless = StockObservation(1000, 'bestbuy', None, '2', 'Burlington', 3, 1.0, None)
+    try:
+        pipeline.process_item(nameless, spider)
+    except DropItem:
+        pass
+    else:
+        raise AssertionError('observations without a product name are dropped')
+
+    try:
+        spider.dao.record_latest_product_stock_batch(pipeline._conn, [(1000, None, 1, 'Burlington', 3, 1.0)])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the DAO refuses observations without a product name')
+
+
+def check_failed_flush(settings: dict):
+    spider, pipeline = open_crawl(settings)
+    product_page(spider, '3', '<h1>Steam Deck</h1>')
+    items = available_stock(spider, ['3'])
+
+    def locked(conn, observations):
+        raise RuntimeError('database is locked')
+
+    record = spider.dao.record_latest_product_stock_batch
+    spider.dao.record_latest_product_stock_batch = locked
+    try:
+        for item in items:
+            pipeline.process_item(item, spider)
+        pipeline.flush(spider)
+    finally:
+        spider.dao.record_latest_product_stock_batch = record
+    assert len(pipeline.writer.buffer) == len(items), 'observations are still pending after a failed write'
+    assert spider.crawler.stats.get_value('stock_writer/flush_errors') == 1
+
+    pipeline.close_spider(spider)
+    assert ('Steam Deck', 3) in stock_rows(spider.dao), 'pending observations are written by the next flush'
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='hyper_scraper_check_')
+    try:
+        settings = {'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'check.db'),
+                    'HISTORY_DIR': os.path.join(workdir, 'history')}
+        for check in (check_nameless_product, check_failed_flush):
+            check(settings)
+            print('ok', check.__name__)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
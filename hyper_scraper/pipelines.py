@@ -5,7 +5,219 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+from pathlib import Path
+from time import gmtime, monotonic, strftime
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.misc import load_object
+from twisted.internet import task
+from db.cache import LatestStockCache
+from db.dao import Dao
+from hyper_scraper.exporters import export_format, open_export
+from hyper_scraper.items import StockObservation
+from notifs import slack
+
+
+class StockWriter:
+    """Records stock observations in batches over a single connection. The
+    restocks, sell outs and price changes among them are appended to the
+    stock event log, which notifs.events delivers to subscribers.
+
+    Observations matching the last known stock in the LatestStockCache are
+    not a stock change and are dropped without touching the database.
+    """
+
+    def __init__(self, dao: Dao, conn, cache: LatestStockCache):
+        self.dao = dao
+        self.conn = conn
+        self.cache = cache
+        self.buffer = []  # observations
+        self.store_ids = {}  # retailer:store_id
+
+    def add(self, item: StockObservation) -> bool:
+        """Buffer an observation. Return false if it was dropped as
+        unchanged.
+        """
+        store_id = self.store_ids.get(item.retailer)
+        if store_id is None:
+            store_id = self.store_ids[item.retailer] = self.dao.get_store_id(item.retailer)
+
+        key = (item.product_name, store_id, item.location)
+        if self.cache.is_unchanged(key, item.quantity, item.price):
+            return False
+
+        # Cache the pending value so repeats before the flush are also skipped
+        self.cache.put(key, item.quantity, item.price)
+        self.buffer.append((item.observed_at,) + key + (item.quantity, item.price))
+        return True
+
+    def flush(self) -> [bool]:
+        """Write all buffered observations in one transaction. Return whether
+        each was a stock change. If the write fails the observations stay
+        buffered for the next flush.
+        """
+        if not self.buffer:
+            return []
+
+        buffer, self.buffer = self.buffer, []
+        try:
+            return self.dao.record_latest_product_stock_batch(self.conn, buffer)
+        except Exception:
+            self.buffer = buffer + self.buffer
+            # Pending values were cached at buffer time but never written
+            self.cache.invalidate()
+            raise
+
+
+class StockWriterPipeline(object):
+    """Records stock observations with a StockWriter.
+
+    Items are buffered and written in one transaction once the buffer reaches
+    STOCK_WRITER_BATCH_SIZE items, once STOCK_WRITER_FLUSH_INTERVAL seconds
+    have passed since the last flush, or when the spider closes. A failed
+    write is counted in the stock_writer/flush_errors stat and retried with
+    the next flush.
+
+    The connection and cache are shared by every crawl in the process, so
+    repeated crawls (see main.py daemon) start warm. A summary of the crawl's
+    observations is sent to the slack health channel when the spider closes.
+    """
+    _conn = None
+    _cache = None
+
+    def __init__(self, dao: Dao, batch_size: int, flush_interval: float, cache_size: int):
+        self.dao = dao
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.writer = None
+        self.observations = 0
+        self.changes = 0
+        self.last_flush = monotonic()
+        self.flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(Dao.from_settings(crawler.settings),
+                   crawler.settings.getint('STOCK_WRITER_BATCH_SIZE', 500),
+                   crawler.settings.getfloat('STOCK_WRITER_FLUSH_INTERVAL', 5.0),
+                   crawler.settings.getint('STOCK_CACHE_MAX_SIZE', 100000))
+
+    def open_spider(self, spider):
+        cls = type(self)
+        if cls._conn is None:
+            cls._conn = self.dao.connect()
+            cls._cache = LatestStockCache(self.dao, self.cache_size)
+            cls._cache.load(cls._conn)
+        elif cls._cache.sync(cls._conn):
+            spider.crawler.stats.inc_value('stock_cache/reloads')
+
+        self.writer = StockWriter(self.dao, cls._conn, cls._cache)
+        self.observations = self.changes = 0
+        self.last_flush = monotonic()
+        self.flush_loop = task.LoopingCall(self._flush_if_due, spider)
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush(spider)
+        if self.writer.buffer:
+            spider.logger.error('%d stock observations were not written', len(self.writer.buffer))
+        self.writer = None
+        slack.send_health_message('{}: {} stock changes out of {} observations'.format(
+            spider.name, self.changes, self.observations))
 
-class ProductScraperPipeline(object):
     def process_item(self, item, spider):
+        if not isinstance(item, StockObservation):
+            return item
+        if not item.product_name or not item.location:
+            # Would fail the whole batch it is flushed with
+            raise DropItem('Stock observation without a product name or location: {}'.format(item))
+
+        self.observations += 1
+        if not self.writer.add(item):
+            spider.crawler.stats.inc_value('stock_cache/hits')
+        elif len(self.writer.buffer) >= self.batch_size:
+            self.flush(spider)
         return item
+
+    def _flush_if_due(self, spider):
+        if self.writer.cache.sync(self.writer.conn):
+            spider.crawler.stats.inc_value('stock_cache/reloads')
+        if monotonic() - self.last_flush >= self.flush_interval:
+            self.flush(spider)
+
+    def flush(self, spider):
+        """Write all buffered observations."""
+        self.last_flush = monotonic()
+        try:
+            stock_changes = self.writer.flush()
+        except Exception:
+            spider.logger.exception('Failed to write %d stock observations', len(self.writer.buffer))
+            spider.crawler.stats.inc_value('stock_writer/flush_errors')
+            return
+        if not stock_changes:
+            return
+
+        self.changes += sum(stock_changes)
+        spider.crawler.stats.inc_value('stock_writer/flushes')
+        spider.crawler.stats.inc_value('stock_writer/observations', len(stock_changes))
+        spider.crawler.stats.inc_value('stock_writer/changes', sum(stock_changes))
+
+
+class StockExportPipeline(object):
+    """Exports the stock observations of every crawl to a file, in batches of
+    STOCK_EXPORT_BATCH_SIZE, with the exporter of its format in
+    STOCK_EXPORTERS.
+
+    The file is STOCK_EXPORT_PATH with %(name)s replaced by the spider's name
+    and %(time)s by the crawl's start time.
+    """
+
+    def __init__(self, path: str, exporter_cls, batch_size: int):
+        self.path = path
+        self.exporter_cls = exporter_cls
+        self.batch_size = batch_size
+        self.file_path = None
+        self.file = None
+        self.exporter = None
+        self.buffer = []
+        self.exported = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('STOCK_EXPORT_PATH')
+        if not path:
+            raise NotConfigured
+
+        exporters = crawler.settings.getdict('STOCK_EXPORTERS')
+        export = export_format(Path(path))
+        if export not in exporters:
+            raise ValueError('No STOCK_EXPORTERS exporter for {} files: {}'.format(export, path))
+        return cls(path, load_object(exporters[export]), crawler.settings.getint('STOCK_EXPORT_BATCH_SIZE'))
+
+    def open_spider(self, spider):
+        self.file_path = Path(self.path % {'name': spider.name, 'time': strftime('%Y-%m-%d_%H:%M:%S_UTC', gmtime())})
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open_export(self.file_path)
+        self.exporter = self.exporter_cls(self.file)
+        self.exported = 0
+
+    def close_spider(self, spider):
+        self.flush()
+        self.exporter.finish()
+        self.file.close()
+        spider.logger.info('Exported %d stock observations to %s', self.exported, self.file_path)
+
+    def process_item(self, item, spider):
+        if isinstance(item, StockObservation):
+            self.buffer.append(item)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+        return item
+
+    def flush(self):
+        if self.buffer:
+            self.exporter.export(self.buffer)
+            self.exported += len(self.buffer)
+            self.buffer = []
@@ -0,0 +1,109 @@
+from time import gmtime, time
+from db.dao import Dao
+from hyper_scraper.watchlist import WatchedProduct
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def _restock_times(history: [tuple]) -> [int]:
+    """Return when a location went from out of stock to in stock."""
+    restocks = []
+    last_quantity = {}  # location_id:quantity
+    for last_updated, location_id, quantity in history:
+        if quantity and not last_quantity.get(location_id):
+            restocks.append(last_updated)
+        last_quantity[location_id] = quantity
+    return restocks
+
+
+class AdaptivePoller:
+    """Decides which of a retailer's watched products to poll this crawl.
+
+    Each product gets a priority from its recent stock history: every stock
+    change counts, decaying with the given half life, and every restock at
+    this hour of the day (plus or minus an hour) in the history window counts
+    a whole point per day of history it was seen on. A product's poll interval
+    shrinks from max_interval towards min_interval as its priority grows, so
+    products that haven't changed in a long time back off to max_interval.
+
+    Due products are polled highest priority first, up to budget availability
+    requests per crawl. Products without any history are always due.
+
+    A product only counts as polled once its stock was fetched: spiders call
+    polled() with the products whose availability came back, and
+    record_polls() when the crawl closes. Products of a crawl that failed or
+    was interrupted first stay due.
+    """
+
+    def __init__(self, dao: Dao, retailer: str, min_interval: float, max_interval: float, budget: int,
+                 half_life: float, window: float):
+        self.dao = dao
+        self.retailer = retailer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget  # 0 for no limit
+        self.half_life = half_life
+        self.window = window
+        self.polled_urls = set()
+
+    def priority(self, history: [tuple], now: float) -> float:
+        volatility = sum(0.5 ** ((now - last_updated) / self.half_life) for last_updated, _, _ in history)
+
+        hour = gmtime(now).tm_hour
+        restock_days = {int(t // DAY) for t in _restock_times(history)
+                        if min(abs(gmtime(t).tm_hour - hour), 24 - abs(gmtime(t).tm_hour - hour)) <= 1}
+        return volatility + len(restock_days)
+
+    def interval(self, priority: float) -> float:
+        return max(self.min_interval, self.max_interval / (1 + priority))
+
+    def select(self, products: [WatchedProduct], requests_per_product: int, now: float = None) -> [WatchedProduct]:
+        """Return the products to poll now. requests_per_product is the
+        number of availability requests each poll costs.
+        """
+        now = time() if now is None else now
+        urls = [p.url for p in products]
+        polls = self.dao.get_product_polls(self.retailer, urls)
+        # Names never change, so metadata of any age will do
+        names = {url: m[0] for url, m in self.dao.get_product_metadata(self.retailer, urls, int(now)).items()}
+        history = self.dao.stock_history(self.retailer, set(names.values()), int(now - self.window))
+
+        due = []  # (priority, product)
+        for product in products:
+            name = names.get(product.url)
+            if name is None or product.url not in polls:
+                due.append((float('inf'), product))
+                continue
+
+            priority = self.priority(history[name], now)
+            if now - polls[product.url] >= self.interval(priority):
+                due.append((priority, product))
+
+        due.sort(key=lambda d: d[0], reverse=True)
+        if self.budget:
+            due = due[:max(1, self.budget // max(1, requests_per_product))]
+
+        return [product for _, product in due]
+
+    def polled(self, urls: [str]) -> None:
+        """Count the products of urls as polled, their stock having been
+        fetched.
+        """
+        self.polled_urls.update(urls)
+
+    def record_polls(self, now: float = None) -> None:
+        """Record when the products counted by polled() were polled."""
+        if self.polled_urls:
+            self.dao.record_product_polls(self.retailer, sorted(self.polled_urls), int(time() if now is None else now))
+            self.polled_urls.clear()
+
+    @classmethod
+    def from_settings(cls, retailer: str, settings):
+        return cls(Dao.from_settings(settings),
+                   retailer,
+                   settings.getfloat('ADAPTIVE_POLL_MIN_INTERVAL'),
+                   settings.getfloat('ADAPTIVE_POLL_MAX_INTERVAL'),
+                   settings.getdict('ADAPTIVE_POLL_REQUEST_BUDGET').get(retailer, 0),
+                   settings.getfloat('ADAPTIVE_POLL_HALF_LIFE'),
+                   settings.getfloat('ADAPTIVE_POLL_HISTORY_WINDOW'))
@@ -0,0 +1,116 @@
+"""Pull values out of the window.__PRELOADED_STATE__ script of Walmart
+product pages without parsing the whole multi-megabyte state.
+
+The state is located directly in the response body bytes. If ijson is
+installed the state is streamed and parsing stops as soon as the wanted
+value is read. Otherwise only the wanted subtree is decoded, falling back to
+decoding the full state if the subtree can't be found on its own.
+"""
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_STATE_START = b'window.__PRELOADED_STATE__='
+_STATE_END = b'</script>'
+
+# Bytes decoded at a time when looking for the end of a subtree
+_WINDOW = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+class PreloadedStateError(ValueError):
+    """The preloaded state is missing or doesn't have the expected shape."""
+    pass
+
+
+def find_state(body: bytes) -> (int, int):
+    """Return the [start, end) byte range of the preloaded state JSON."""
+    start = body.find(_STATE_START)
+    if start == -1:
+        raise PreloadedStateError('preloaded state not found')
+    start += len(_STATE_START)
+
+    end = body.find(_STATE_END, start)
+    if end == -1:
+        raise PreloadedStateError('preloaded state script is not closed')
+
+    # Drop the trailing semicolon and whitespace of the statement
+    while end > start and body[end - 1] in b'; \t\r\n':
+        end -= 1
+    return start, end
+
+
+class _MemoryReader:
+    """Minimal file object over a memoryview, copying one read at a time."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size < 0 else self._pos + size
+        data = self._view[self._pos:end].tobytes()
+        self._pos += len(data)
+        return data
+
+
+def _decode_at(body: bytes, pos: int, end: int):
+    """Decode the JSON value starting at pos, decoding no more than needed."""
+    while pos < end and body[pos] in b' \t\r\n':
+        pos += 1
+
+    window = _WINDOW
+    while True:
+        stop = min(pos + window, end)
+        # A window may split a multi-byte character at its end, which only
+        # matters if the value runs past it
+        text = body[pos:stop].decode('utf-8', errors='ignore')
+        try:
+            return _decoder.raw_decode(text)[0]
+        except json.JSONDecodeError:
+            if stop == end:
+                raise
+            window *= 4
+
+
+def _skus(body: bytes, start: int, end: int) -> dict:
+    # Fast path: decode just the object after the first "skus" key following
+    # "entities"
+    entities = body.find(b'"entities":', start, end)
+    skus = body.find(b'"skus":', entities, end) if entities != -1 else -1
+    if skus != -1:
+        try:
+            data = _decode_at(body, skus + len(b'"skus":'), end)
+            if isinstance(data, dict) and all(isinstance(s, dict) and 'upc' in s for s in data.values()):
+                return data
+        except json.JSONDecodeError:
+            pass
+
+    try:
+        return json.loads(body[start:end])['entities']['skus']
+    except (ValueError, KeyError, TypeError) as e:
+        raise PreloadedStateError('no entities.skus in preloaded state: {}'.format(e))
+
+
+def extract_upc(body: bytes) -> str:
+    """Return the UPC of the first SKU in the preloaded state of a product page."""
+    start, end = find_state(body)
+
+    if ijson is not None:
+        try:
+            reader = _MemoryReader(memoryview(body)[start:end])
+            for _, sku in ijson.kvitems(reader, 'entities.skus'):
+                return sku['upc'][0]
+        except (ijson.JSONError, KeyError, IndexError, TypeError) as e:
+            raise PreloadedStateError('invalid preloaded state: {}'.format(e))
+        raise PreloadedStateError('no skus in preloaded state')
+
+    skus = _skus(body, start, end)
+    try:
+        return next(iter(skus.values()))['upc'][0]
+    except (StopIteration, KeyError, IndexError, TypeError) as e:
+        raise PreloadedStateError('no sku upc in preloaded state: {}'.format(e))
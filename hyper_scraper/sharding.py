@@ -0,0 +1,242 @@
+"""Crawls the watchlist with several worker processes and one writer.
+
+The watchlist is split into shards of (retailer, postal codes, products).
+Each shard is crawled by a worker process with its own reactor, so callbacks
+parse on every core. Workers stream their stock observations back over a
+queue to the coordinating process, which is the only one recording stock.
+Its LatestStockCache drops observations already seen from another shard, so
+every stock change is recorded once. It also delivers the stock events to
+their subscribers, workers don't.
+"""
+from dataclasses import fields
+from operator import attrgetter
+from pathlib import Path
+from time import monotonic
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+from db.cache import LatestStockCache
+from db.dao import Dao
+from hyper_scraper.items import StockObservation
+from hyper_scraper.pipelines import StockWriter
+from hyper_scraper.polling import AdaptivePoller
+from hyper_scraper.watchlist import RetailerWatchlist, load_watchlist, save_watchlist
+from notifs import slack
+from notifs.events import SHUTDOWN_TIMEOUT, EventDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Queue the worker's ObservationSinkPipeline sends observations to
+_results = None
+
+# Observations are sent as tuples of their fields, which pickle smaller
+_observation_fields = attrgetter(*(f.name for f in fields(StockObservation)))
+
+
+def shard_watchlist(watchlist: {str: RetailerWatchlist}, shards: int) -> [{str: RetailerWatchlist}]:
+    """Split a watchlist into up to shards watchlists.
+
+    A retailer's products are dealt round robin over the shards, each with all
+    of its postal codes. A retailer with fewer products than shards also has
+    its postal codes split, so every shard gets at most one (product, postal
+    codes) cell of it. Empty shards are dropped.
+    """
+    result = [{} for _ in range(shards)]
+    offset = 0
+    for retailer, entry in watchlist.items():
+        if not entry.products or not entry.postal_codes:
+            continue
+
+        if len(entry.products) >= shards:
+            cells = [(entry.postal_codes, entry.products[i::shards]) for i in range(shards)]
+        else:
+            groups = max(1, min(len(entry.postal_codes), shards // len(entry.products)))
+            cells = [(entry.postal_codes[g::groups], (product,))
+                     for product in entry.products for g in range(groups)]
+
+        for i, (postal_codes, products) in enumerate(cells):
+            result[(offset + i) % shards][retailer] = RetailerWatchlist(postal_codes, products)
+        offset += len(cells)
+
+    return [shard for shard in result if shard]
+
+
+class ObservationSinkPipeline(object):
+    """Sends the stock observations of a worker's crawl to the writer in
+    batches of STOCK_WRITER_BATCH_SIZE.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.buffer = []  # observation fields
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('STOCK_WRITER_BATCH_SIZE', 500))
+
+    def close_spider(self, spider):
+        self.flush()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, StockObservation):
+            return item
+
+        self.buffer.append(_observation_fields(item))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        if self.buffer:
+            _results.put(('observations', self.buffer))
+            self.buffer = []
+
+
+def shard_export_path(path: str, index: int) -> str:
+    """Return the STOCK_EXPORT_PATH of a shard, e.g. logs/x_shard1.jsonl.gz
+    for logs/x.jsonl.gz, so shards don't export to the same file.
+    """
+    head, sep, name = path.rpartition('/')
+    stem, dot, suffixes = name.partition('.')
+    return head + sep + stem + '_shard{}'.format(index) + dot + suffixes
+
+
+def _crawl_shard(index: int, watchlist_path: str, settings_dict: dict, results):
+    """Worker process: crawl the shard's retailers, then report their stats."""
+    global _results
+    _results = results
+
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.settings import Settings
+
+    settings = Settings(settings_dict)
+    settings.set('ITEM_PIPELINES', {'hyper_scraper.sharding.ObservationSinkPipeline': 300,
+                                    'hyper_scraper.pipelines.StockExportPipeline': 400})
+    if settings.get('STOCK_EXPORT_PATH'):
+        settings.set('STOCK_EXPORT_PATH', shard_export_path(settings.get('STOCK_EXPORT_PATH'), index))
+    settings.set('ADAPTIVE_POLL_ENABLED', False)  # products were picked by the coordinator
+    settings.set('EVENT_SUBSCRIBERS', {})  # delivered by the coordinator
+
+    process = CrawlerProcess(settings)
+    crawlers = []
+    for retailer in load_watchlist(watchlist_path):
+        crawler = process.create_crawler(retailer)
+        crawlers.append(crawler)
+        process.crawl(crawler, watchlist=watchlist_path)
+    process.start()
+
+    results.put(('done', index, {c.spider.name: c.stats.get_stats() for c in crawlers}))
+
+
+def _select_products(watchlist: {str: RetailerWatchlist}, settings) -> {str: RetailerWatchlist}:
+    """Pick the products adaptive polling says are due, for the retailers whose
+    spider polls adaptively, before the products are split over shards.
+    """
+    if not settings.getbool('ADAPTIVE_POLL_ENABLED'):
+        return watchlist
+
+    from scrapy.spiderloader import SpiderLoader
+    spiders = SpiderLoader.from_settings(settings)
+
+    selected = {}
+    for retailer, entry in watchlist.items():
+        if getattr(spiders.load(retailer), 'adaptive_polling', False):
+            poller = AdaptivePoller.from_settings(retailer, settings)
+            entry = RetailerWatchlist(entry.postal_codes, tuple(poller.select(entry.products,
+                                                                              len(entry.postal_codes))))
+        selected[retailer] = entry
+    return selected
+
+
+def _record_results(results, processes: {int: multiprocessing.Process}, settings) -> {str: [dict]}:
+    """Record the observations the workers send until they're all done.
+    Return the stats of every crawl by retailer.
+    """
+    dao = Dao.from_settings(settings)
+    conn = dao.connect()
+    try:
+        cache = LatestStockCache(dao, settings.getint('STOCK_CACHE_MAX_SIZE'))
+        cache.load(conn)
+        return _write_results(results, processes, StockWriter(dao, conn, cache), settings)
+    finally:
+        conn.close()
+
+
+def _write_results(results, processes: {int: multiprocessing.Process}, writer: StockWriter,
+                   settings) -> {str: [dict]}:
+    stats = {}  # retailer:[stats]
+    batch_size = settings.getint('STOCK_WRITER_BATCH_SIZE')
+    flush_interval = settings.getfloat('STOCK_WRITER_FLUSH_INTERVAL')
+    last_flush = monotonic()
+    observations = changes = 0
+
+    running = set(processes)
+    while running:
+        try:
+            message = results.get(timeout=flush_interval)
+        except queue.Empty:
+            message = (None,)
+
+        if message[0] == 'observations':
+            observations += len(message[1])
+            for values in message[1]:
+                writer.add(StockObservation(*values))
+        elif message[0] == 'done':
+            _, index, shard_stats = message
+            running.discard(index)
+            for retailer, crawl_stats in shard_stats.items():
+                stats.setdefault(retailer, []).append(crawl_stats)
+
+        # Workers that died never say they're done
+        for index in [i for i in running if processes[i].exitcode not in (None, 0)]:
+            logger.error('Shard %d exited with %s', index, processes[index].exitcode)
+            running.discard(index)
+
+        if len(writer.buffer) >= batch_size or monotonic() - last_flush >= flush_interval:
+            changes += sum(writer.flush())
+            last_flush = monotonic()
+
+    changes += sum(writer.flush())
+
+    logger.info('Recorded %d stock changes out of %d observations from %d shards',
+                changes, observations, len(processes))
+    slack.send_health_message('{} stock changes out of {} observations from {} shards'.format(
+        changes, observations, len(processes)))
+    return stats
+
+
+def run_sharded(settings, workers: int) -> {str: [dict]}:
+    """Crawl the watchlist with workers processes and record their
+    observations here. Return the stats of every crawl by retailer.
+    """
+    watchlist = _select_products(load_watchlist(settings.get('WATCHLIST_FILE')), settings)
+    shards = shard_watchlist(watchlist, workers)
+
+    # Workers are spawned rather than forked so they don't share this
+    # process's reactor
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue(settings.getint('SHARD_QUEUE_SIZE'))
+    dispatcher = EventDispatcher.from_settings(Dao.from_settings(settings), settings)
+    dispatcher.start()
+
+    with tempfile.TemporaryDirectory(prefix='hyper_scraper_shards_') as shard_dir:
+        processes = {}  # shard index:Process
+        for i, shard in enumerate(shards):
+            path = str(Path(shard_dir) / 'shard_{}.json'.format(i))
+            save_watchlist(shard, path)
+            processes[i] = context.Process(target=_crawl_shard, args=(i, path, settings.copy_to_dict(), results),
+                                           name='hyper-scraper-shard-{}'.format(i))
+            processes[i].start()
+
+        stats = _record_results(results, processes, settings)
+        for process in processes.values():
+            process.join()
+
+    dispatcher.stop(SHUTDOWN_TIMEOUT)
+    return stats
+
+
+def default_workers() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
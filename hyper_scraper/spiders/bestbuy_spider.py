@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 import scrapy
-import json
-from lxml import html
-from time import gmtime, strftime
+from math import ceil
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from time import time
+from urllib.parse import quote
 from notifs import slack
-from pathlib import Path
-
-
-def strip_html(s):
-    return str(html.fromstring(s).text_content())
+from db.dao import Dao
+from hyper_scraper import decoding
+from hyper_scraper.items import StockObservation
+from hyper_scraper.locations import LocationRegistry
+from hyper_scraper.middlewares import UnchangedResponse
+from hyper_scraper.polling import AdaptivePoller
+from hyper_scraper.watchlist import load_watchlist
 
 
 def bestbuy_loc_url(postal_code: str) -> str:
@@ -16,12 +20,43 @@ def bestbuy_loc_url(postal_code: str) -> str:
     return 'https://www.bestbuy.ca/api/v2/json/locations?lang=en-CA&postalCode=' + postal_code[:3]
 
 
-def bestbuy_available_stock_url(location_ids: [str], postal_code: str, sku: str) -> str:
-    locations = '|'.join(location_ids)
-
+def bestbuy_available_stock_url(location_ids: [str], postal_code: str, skus: [str]) -> str:
     return 'https://www.bestbuy.ca/ecomm-api/availability/products?accept=application/'\
         'vnd.bestbuy.standardproduct.v1+json&accept-language=en-CA&'\
-        'locations={}&postalCode={}&skus={}'.format(locations, postal_code[:3], sku)
+        'locations={}&postalCode={}&skus={}'.format('|'.join(location_ids), postal_code[:3], '|'.join(skus))
+
+
+def plan_availability_queries(skus: [str], location_ids: [str], max_url_length: int) -> [([str], [str])]:
+    """Split every (sku, location) pair into the fewest availability queries
+    whose URLs fit in max_url_length. Returns the (skus, location_ids) of
+    each query.
+    """
+    if not skus or not location_ids:
+        return []
+
+    # Requests percent-encode the '|' separators
+    separator_length = len(quote('|'))
+    base_length = len(bestbuy_available_stock_url([], 'X0X', []))
+    sku_length = max(map(len, skus)) + separator_length
+    location_length = max(map(len, location_ids)) + separator_length
+
+    best = None  # (queries, skus per query, locations per query)
+    for per_query in range(1, len(skus) + 1):
+        locations_per_query = min(len(location_ids),
+                                  (max_url_length - base_length - per_query * sku_length) // location_length)
+        if locations_per_query < 1:
+            break
+        queries = ceil(len(skus) / per_query) * ceil(len(location_ids) / locations_per_query)
+        if best is None or queries < best[0]:
+            best = (queries, per_query, locations_per_query)
+
+    if best is None:
+        raise ValueError('max_url_length {} is too short for a single sku and location'.format(max_url_length))
+
+    _, per_query, locations_per_query = best
+    return [(skus[i:i + per_query], location_ids[j:j + locations_per_query])
+            for i in range(0, len(skus), per_query)
+            for j in range(0, len(location_ids), locations_per_query)]
 
 
 def bestbuy_get_sku_from_product_url(url: str) -> str:
@@ -30,83 +65,158 @@ def bestbuy_get_sku_from_product_url(url: str) -> str:
     return url.split('/')[-1]
 
 
-class BestbuyNintendoSwitchSpider(scrapy.Spider):
-    name = 'bestbuy_nintendo_switch'
+class BestbuySpider(scrapy.Spider):
+    """Checks the stock of every watched Best Buy product near every watched
+    postal code.
+
+    Location and product page requests are all sent up front. Once they are
+    all answered, every (location, product) pair is packed into as few
+    availability requests as BESTBUY_AVAILABILITY_MAX_URL_LENGTH allows.
+    Stores near more than one watched postal code are only requested once.
+    Stores are kept in the crawl's LocationRegistry, requests only carry
+    their location IDs. Stock is only yielded as StockObservations, the
+    pipelines record and export it.
+    """
+    name = 'bestbuy'
+    retailer = 'bestbuy'
+    adaptive_polling = True
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
 
     def start_requests(self):
         slack.send_health_message('Starting Bestbuy check...')
-        postal_code = 'L7T1X4'
-        yield scrapy.Request(url=bestbuy_loc_url(postal_code), callback=self.parse_loc, meta={'start_gmtime': gmtime(),
-                                                                                              'postal_code': postal_code})
+        self.dao = Dao.from_settings(self.settings)
+        self.observed_at = int(time())
+
+        watchlist = load_watchlist(getattr(self, 'watchlist', None) or self.settings.get('WATCHLIST_FILE'))
+        retailer_watchlist = watchlist[self.retailer]
+
+        self.locations = LocationRegistry()
+        self.products = {}  # sku:(product_name, price)
+        self.product_urls = {}  # sku:url
+        self.planned = False
+
+        products = retailer_watchlist.products
+        self.poller = None
+        if self.adaptive_polling and self.settings.getbool('ADAPTIVE_POLL_ENABLED'):
+            # A product costs about an availability request per postal code
+            # prefix, less when queries pack several together
+            self.poller = AdaptivePoller.from_settings(self.retailer, self.settings)
+            products = self.poller.select(products, len({p[:3] for p in retailer_watchlist.postal_codes}))
+            self.crawler.stats.set_value('adaptive_poll/skipped', len(retailer_watchlist.products) - len(products))
+            if not products:
+                return
+
+        # The locations API only uses the first 3 digits of the postal code.
+        # Stores near a postal code rarely change, so reuse recent lookups.
+        location_ttl = self.settings.getint('LOCATION_CACHE_TTL')
+        for postal_prefix in dict.fromkeys(p[:3] for p in retailer_watchlist.postal_codes):
+            payload = self.dao.get_cached_locations(self.retailer, postal_prefix, location_ttl)
+            if payload is not None:
+                self.crawler.stats.inc_value('location_cache/hits')
+                self._parse_loc_data(postal_prefix, payload)
+            else:
+                yield scrapy.Request(url=bestbuy_loc_url(postal_prefix), callback=self.parse_loc,
+                                     meta={'postal_code': postal_prefix})
+
+        # Only fetch product pages whose name and price are missing or stale
+        urls = [product.url for product in products]
+        metadata = self.dao.get_product_metadata(self.retailer, urls, self.settings.getint('PRODUCT_METADATA_TTL'))
+        for product in products:
+            sku = product.sku or bestbuy_get_sku_from_product_url(product.url)
+            self.product_urls[sku] = product.url
+            if product.url in metadata:
+                self.crawler.stats.inc_value('product_metadata/hits')
+                product_name, _, price = metadata[product.url]
+                self.products[sku] = (product_name, price)
+            else:
+                yield scrapy.Request(url=product.url,
+                                     callback=self.parse_product_page,
+                                     meta={'url': product.url,
+                                           'sku': sku})
 
     def parse_loc(self, response):
-        data = json.loads(response.body)
-
-        location_info = {}  # loc_ids:info
-        for loc in data['locations']:
-            loc_id = loc['locationId']
-            location_info[loc_id] = loc
-
-        urls = [
-            'https://www.bestbuy.ca/en-ca/product/nintendo-switch-console-with-neon-red-blue-joy-con/13817625',
-            'https://www.bestbuy.ca/en-ca/product/nintendo-switch-console-with-grey-joy-con/13817626'
-        ]
-        for url in urls:
-            sku = bestbuy_get_sku_from_product_url(url)
-
-            yield scrapy.Request(url=url,
-                                 callback=self.parse_product_page,
-                                 meta={'start_gmtime': response.meta['start_gmtime'],
-                                       'postal_code': response.meta['postal_code'],
-                                       'location_info': location_info,
-                                       'sku': sku})
+        postal_code = response.meta['postal_code']
+        self.dao.cache_locations(self.retailer, postal_code, response.text)
+        self._parse_loc_data(postal_code, response.body)
+
+    def _parse_loc_data(self, postal_code: str, body):
+        for loc_id, name, address1, address2, city in decoding.records(
+                body, 'locations', ('locationId', 'name', 'address1', 'address2', 'city')):
+            address = address1 + ' ' + address2 if address2 else address1
+            self.locations.add(loc_id, name, address + ', ' + city, postal_code)
 
     def parse_product_page(self, response):
         product_name = response.xpath('//div[contains(@class, "x-product-detail-page")]/h1/text()').get()
-        price = response.xpath('//meta[@itemProp="price"]/@content').get()
-
-        yield scrapy.Request(url=bestbuy_available_stock_url(response.meta['location_info'].keys(),
-                                                             response.meta['postal_code'],
-                                                             response.meta['sku']),
-                             callback=self.parse_available_stock,
-                             meta={'start_gmtime': response.meta['start_gmtime'],
-                                   'product_name': product_name,
-                                   'price': price})
+        # lxml lowercases attribute names, itemProp is matched as itemprop
+        price = response.xpath('//meta[@itemprop="price"]/@content').get()
+        price = float(price) if price else None
+        if product_name is None or price is None:
+            # Skip the product this crawl and fetch the page again next crawl
+            self.logger.warning('No product name or price on %s', response.url)
+            self.crawler.stats.inc_value('product_metadata/incomplete')
+            return
+        self.dao.save_product_metadata(self.retailer, response.meta['url'], product_name, price=price)
+        self.products[response.meta['sku']] = (product_name, price)
+
+    def spider_idle(self, spider):
+        # All location and product lookups are done, query their availability
+        if self.planned:
+            return
+        self.planned = True
+
+        requests = self._available_stock_requests()
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if requests:
+            raise DontCloseSpider
+
+    def _available_stock_requests(self) -> [scrapy.Request]:
+        queries = plan_availability_queries(list(self.products), self.locations.ids(),
+                                            self.settings.getint('BESTBUY_AVAILABILITY_MAX_URL_LENGTH'))
+        self.crawler.stats.set_value('availability/queries', len(queries))
+        return [scrapy.Request(url=bestbuy_available_stock_url(location_ids,
+                                                               self.locations[location_ids[0]].postal_code,
+                                                               skus),
+                               callback=self.parse_available_stock,
+                               errback=self.availability_failed,
+                               meta={'skip_unchanged': True, 'skus': skus})
+                for skus, location_ids in queries]
 
     def parse_available_stock(self, response):
-        data = json.loads(response.body)
-        product_name = response.meta['product_name']
-
-        Path('logs').mkdir(parents=True, exist_ok=True)
-        filename = 'logs/' + self.name + '_' + strftime("%Y-%m-%d_%H:%M:%S_UTC", response.meta['start_gmtime']) + '.log'
-        msg = ''
-        with open(filename, 'a') as f:
-            for product in data['availabilities']:
-                pickup = product['pickup']
-                if pickup['status'] != 'OutOfStock':
-                    for loc in pickup['locations']:
-                        quantity = loc['quantityOnHand']
-                        if quantity > 0:
-                            loc_info = response.meta['location_info'][loc['locationKey']]
-
-                            loc_name = loc_info['name']
-                            loc_addr = loc_info['address1']
-                            if loc_info['address2']:
-                                loc_addr += ' ' + loc_info['address2']
-                            loc_addr += ', ' + loc_info['city']
-
-                            msg = '{}: {} at {} - price ${}, availability {}\n'.format(product_name,
-                                                                                       loc_name,
-                                                                                       loc_addr,
-                                                                                       response.meta['price'],
-                                                                                       quantity)
-
-                            slack.send_message(msg)
-                else:
-                    msg = '{}: Bestbuys are out of stock'.format(response.meta['product_name'])
-
-            f.write(msg)
-
-        status_msg = '{}: found {} locations, saved in {}'.format(product_name, len(response.meta['location_info']), filename)
-        self.log(status_msg)
-        slack.send_health_message(status_msg)
+        availabilities = decoding.records(response.body, 'availabilities', ('sku', 'pickup'))
+
+        for sku, pickup in availabilities:
+            product_name, price = self.products[sku]
+            for loc in pickup['locations']:
+                location = self.locations[loc['locationKey']]
+                yield StockObservation(observed_at=self.observed_at,
+                                       retailer=self.retailer,
+                                       product_name=product_name,
+                                       sku=sku,
+                                       location=location.name + ' at ' + location.address,
+                                       quantity=loc['quantityOnHand'],
+                                       price=price,
+                                       status=None)
+
+            self.logger.debug('%s: %s at %d locations', product_name, pickup['status'], len(pickup['locations']))
+
+        self._polled(response.meta['skus'])
+
+    def availability_failed(self, failure):
+        # An availability unchanged since the last crawl was still polled
+        if failure.check(UnchangedResponse):
+            self._polled(failure.request.meta['skus'])
+        return failure
+
+    def _polled(self, skus: [str]):
+        if self.poller is not None:
+            self.poller.polled([self.product_urls[sku] for sku in skus])
+
+    def closed(self, reason):
+        if self.poller is not None:
+            self.poller.record_polls(self.observed_at)
@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 import scrapy
-import json
-from lxml import html
-from time import strftime, mktime
+from time import time
 from notifs import slack
-from pathlib import Path
 from db.dao import Dao
-
-
-def strip_html(s):
-    return str(html.fromstring(s).text_content())
-
-
-class WalmartNintendoSwitchSpider(scrapy.Spider):
-    name = 'walmart_nintendo_switch'
+from hyper_scraper import decoding
+from hyper_scraper.items import StockObservation
+from hyper_scraper.middlewares import UnchangedResponse
+from hyper_scraper.polling import AdaptivePoller
+from hyper_scraper.preloaded_state import extract_upc
+from hyper_scraper.watchlist import load_watchlist
+
+# NOTE(sdsmith): These are totally out of the blue numbers
+AVAILABILITY_QUANTITIES = {'OUT_OF_STOCK': 0,
+                           'LIMITED': 5,
+                           'AVAILABLE': 30}
+
+
+class WalmartSpider(scrapy.Spider):
+    """Checks the stock of every watched Walmart product near every watched
+    postal code.
+
+    Geo-location and product page requests are all sent up front. Each
+    availability request is sent as soon as both its coordinates and its
+    product UPC are known, so every (location, product) pair is requested
+    exactly once. Stock is only yielded as StockObservations, the pipelines
+    record and export it.
+    """
+    name = 'walmart'
+    retailer = 'walmart'
+    adaptive_polling = True
 
     def _loc_url(self, zip_code: str) -> str:
         return 'https://www.walmart.ca/api/product-page/geo-location?postalCode=' + zip_code
@@ -23,83 +38,120 @@ class WalmartNintendoSwitchSpider(scrapy.Spider):
             'latitude={}&longitude={}&lang=en&upc={}'.format(latitude, longitude, upc)
 
     def start_requests(self):
-        store_name = 'walmart'
-
         slack.send_health_message('Starting Walmart check...')
-        store_id = Dao.get_store_id(store_name)
-
-        # TODO(sdsmith): only do the loc call if it has changed!
-        yield scrapy.Request(url=self._loc_url('L7T1X4'), callback=self.parse_loc, meta={'db': {'store_id': store_id}})
+        self.dao = Dao.from_settings(self.settings)
+        self.observed_at = int(time())
+
+        watchlist = load_watchlist(getattr(self, 'watchlist', None) or self.settings.get('WATCHLIST_FILE'))
+        retailer_watchlist = watchlist[self.retailer]
+
+        products = retailer_watchlist.products
+        self.poller = None
+        if self.adaptive_polling and self.settings.getbool('ADAPTIVE_POLL_ENABLED'):
+            self.poller = AdaptivePoller.from_settings(self.retailer, self.settings)
+            products = self.poller.select(products, len(retailer_watchlist.postal_codes))
+            self.crawler.stats.set_value('adaptive_poll/skipped', len(retailer_watchlist.products) - len(products))
+            if not products:
+                return
+
+        self.coordinates = set()  # (latitude, longitude)
+        self.products = {}  # upc:product_name
+        self.product_urls = {}  # upc:url
+
+        # Coordinates of a postal code rarely change, so reuse recent lookups
+        location_ttl = self.settings.getint('LOCATION_CACHE_TTL')
+        for postal_code in retailer_watchlist.postal_codes:
+            payload = self.dao.get_cached_locations(self.retailer, postal_code, location_ttl)
+            if payload is not None:
+                self.crawler.stats.inc_value('location_cache/hits')
+                yield from self._parse_loc_data(decoding.loads(payload))
+            else:
+                yield scrapy.Request(url=self._loc_url(postal_code), callback=self.parse_loc,
+                                     meta={'postal_code': postal_code})
+
+        # Product names and UPCs never change, only fetch pages we don't know
+        urls = [product.url for product in products]
+        metadata = self.dao.get_product_metadata(self.retailer, urls, self.settings.getint('PRODUCT_METADATA_TTL'))
+        for url in urls:
+            if url in metadata:
+                self.crawler.stats.inc_value('product_metadata/hits')
+                product_name, upc, _ = metadata[url]
+                yield from self._add_product(upc, product_name, url)
+            else:
+                yield scrapy.Request(url=url, callback=self.parse_product_page, meta={'url': url})
 
     def parse_loc(self, response):
-        data = json.loads(response.body)
-        latitude = data['lat']
-        longitude = data['lng']
-
-        urls = [
-            'https://www.walmart.ca/en/ip/nintendo-switch-with-neon-blue-and-neon-red-joycon-nintendo-switch/6000200280557',
-            'https://www.walmart.ca/en/ip/nintendo-switch-with-gray-joycon-nintendo-switch/6000200280830'
-        ]
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse_product_page,
-                                 meta={'latitude': latitude,
-                                       'longitude': longitude,
-                                       'db': response.meta['db']})
+        self.dao.cache_locations(self.retailer, response.meta['postal_code'], response.text)
+        yield from self._parse_loc_data(decoding.loads(response.body))
 
-    def parse_product_page(self, response):
-        latitude = response.meta['latitude']
-        longitude = response.meta['longitude']
+    def _parse_loc_data(self, data: dict):
+        coordinate = (data['lat'], data['lng'])
+
+        # Nearby postal codes can share coordinates
+        if coordinate in self.coordinates:
+            return
+        self.coordinates.add(coordinate)
+
+        # Scrapy consumes these generators lazily, while other callbacks add
+        # products and coordinates
+        for upc, product_name in list(self.products.items()):
+            yield self._available_stock_request(coordinate, upc, product_name)
 
+    def parse_product_page(self, response):
         product_name = response.xpath('//h1[@data-automation="product-title"]/text()').get().strip()
 
-        text = strip_html(response.css('body script:first-of-type').getall()[1])
-        start_js = 'window.__PRELOADED_STATE__='
-        if text.find(start_js) != 0:
-            self.log("JS start is not found!")
-            assert False
-        text = text[len(start_js):-1]
-        data = json.loads(text)
+        upc = extract_upc(response.body)
+
+        self.dao.save_product_metadata(self.retailer, response.meta['url'], product_name, upc=upc)
+        yield from self._add_product(upc, product_name, response.meta['url'])
+
+    def _add_product(self, upc: str, product_name: str, url: str):
+        if upc in self.products:
+            return
+        self.products[upc] = product_name
+        self.product_urls[upc] = url
 
-        skus_data = data['entities']['skus']
-        upc = skus_data[list(skus_data)[0]]['upc'][0]
+        for coordinate in list(self.coordinates):
+            yield self._available_stock_request(coordinate, upc, product_name)
 
-        yield scrapy.Request(url=self._available_stock_url(latitude, longitude, upc),
-                             callback=self.parse_available_stock,
-                             meta={'product_name': product_name,
-                                   'db': response.meta['db']})
+    def _available_stock_request(self, coordinate: (str, str), upc: str, product_name: str) -> scrapy.Request:
+        latitude, longitude = coordinate
+        return scrapy.Request(url=self._available_stock_url(latitude, longitude, upc),
+                              callback=self.parse_available_stock,
+                              errback=self.availability_failed,
+                              meta={'product_name': product_name,
+                                    'upc': upc,
+                                    'skip_unchanged': True})
 
     def parse_available_stock(self, response):
-        data = json.loads(response.body)
+        locations = decoding.records(response.body, 'info',
+                                     ('displayName', 'intersection', 'availabilityStatus', 'sellPrice'))
         product_name = response.meta['product_name']
-        start_datetime = self.crawler.stats.get_stats(self)['start_time']  # in utc
-        start_time_epoch = mktime(start_datetime.timetuple())
-
-        Path('logs').mkdir(parents=True, exist_ok=True)
-        logfile = 'logs/' + self.name + '_' + strftime("%Y-%m-%d_%H:%M:%S_UTC", start_datetime.timetuple()) + '.log'
-
-        # NOTE(sdsmith): These are totally out of the blue numbers
-        availStatusToQuantity = {'OUT_OF_STOCK': 0,
-                                 'LIMITED': 5,
-                                 'AVAILABLE': 30}
-
-        with open(logfile, 'a') as f:
-            for i, loc in enumerate(data['info']):
-                location = loc['displayName'] + ', ' + loc['intersection']
-                quantity = availStatusToQuantity[loc['availabilityStatus']]
-                price = float(loc['sellPrice'])
-                msg = '{}: {} - price ${}, availability {}\n'.format(product_name,
-                                                                     location,
-                                                                     price,
-                                                                     loc['availabilityStatus'])
-
-                store_id = response.meta['db']['store_id']
-                is_change = Dao.record_latest_product_stock(start_time_epoch, product_name, store_id,
-                                                            location, quantity, price)
-                if is_change:
-                    slack.send_message(msg)
-
-                f.write(msg)
-
-            status_msg = '{}: found {} locations, saved in {}'.format(product_name, i + 1, logfile)
-            self.log(status_msg)
-            slack.send_health_message(status_msg)
+        upc = response.meta['upc']
+
+        for display_name, intersection, availability_status, sell_price in locations:
+            yield StockObservation(observed_at=self.observed_at,
+                                   retailer=self.retailer,
+                                   product_name=product_name,
+                                   sku=upc,
+                                   location=display_name + ', ' + intersection,
+                                   quantity=AVAILABILITY_QUANTITIES[availability_status],
+                                   price=float(sell_price),
+                                   status=availability_status)
+
+        self.logger.debug('%s: found %d locations', product_name, len(locations))
+        self._polled(upc)
+
+    def availability_failed(self, failure):
+        # An availability unchanged since the last crawl was still polled
+        if failure.check(UnchangedResponse):
+            self._polled(failure.request.meta['upc'])
+        return failure
+
+    def _polled(self, upc: str):
+        if self.poller is not None:
+            self.poller.polled([self.product_urls[upc]])
+
+    def closed(self, reason):
+        if self.poller is not None:
+            self.poller.record_polls(self.observed_at)
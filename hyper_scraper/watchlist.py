@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import NamedTuple, Tuple
+import json
+
+
+class WatchedProduct(NamedTuple):
+    url: str
+    sku: str = None
+    upc: str = None
+
+
+class RetailerWatchlist(NamedTuple):
+    postal_codes: Tuple[str, ...]
+    products: Tuple[WatchedProduct, ...]
+
+
+class WatchlistError(ValueError):
+    pass
+
+
+def _parse_file(path: Path) -> dict:
+    suffix = path.suffix.lower()
+    if suffix in ('.yml', '.yaml'):
+        try:
+            import yaml
+        except ImportError:
+            raise WatchlistError('PyYAML is required to read {}'.format(path))
+        with path.open() as f:
+            return yaml.safe_load(f)
+
+    if suffix == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise WatchlistError('tomli is required to read {} before Python 3.11'.format(path))
+        with path.open('rb') as f:
+            return tomllib.load(f)
+
+    with path.open() as f:
+        return json.load(f)
+
+
+def load_watchlist(path: str) -> {str: RetailerWatchlist}:
+    """Load the retailers, postal codes and products to watch from a JSON,
+    YAML or TOML file. Duplicate postal codes and products are dropped.
+
+    The file has a 'retailers' table keyed by retailer name, e.g.:
+
+        {"retailers": {"walmart": {"postal_codes": ["L7T1X4"],
+                                   "products": [{"url": "https://..."}]}}}
+
+    Products may also give a 'sku' or 'upc' when the retailer needs one.
+    """
+    data = _parse_file(Path(path))
+    if not isinstance(data, dict) or not isinstance(data.get('retailers'), dict):
+        raise WatchlistError('{}: missing retailers table'.format(path))
+
+    watchlist = {}
+    for retailer, entry in data['retailers'].items():
+        try:
+            postal_codes = tuple(dict.fromkeys(p.replace(' ', '').upper() for p in entry['postal_codes']))
+            products = tuple(dict.fromkeys(WatchedProduct(**p) for p in entry['products']))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise WatchlistError('{}: invalid entry for {}: {}'.format(path, retailer, e))
+
+        watchlist[retailer] = RetailerWatchlist(postal_codes, products)
+
+    return watchlist
+
+
+def save_watchlist(watchlist: {str: RetailerWatchlist}, path: str) -> None:
+    """Write a watchlist as JSON that load_watchlist reads back."""
+    data = {'retailers': {retailer: {'postal_codes': list(entry.postal_codes),
+                                     'products': [{k: v for k, v in p._asdict().items() if v is not None}
+                                                  for p in entry.products]}
+                          for retailer, entry in watchlist.items()}}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4)
@@ -1,25 +1,139 @@
 #!/usr/bin/env python3
+"""Crawl every retailer in the watchlist, or run one of the commands:
 
+    stock               post the products in stock to slack and print them
+    daemon              crawl each retailer on its interval until stopped
+    sharded [workers]   crawl the watchlist with worker processes
+    compact             move old stock history into history segments
+    events              deliver stock events to their subscribers until stopped
+    report ...          report on the stock history, see `main.py report -h`
+
+Commands import what they need when they run, so the ones that don't crawl
+start without loading Scrapy, Twisted or the spiders.
+"""
+import importlib
+import os
 import sys
-from scrapy.crawler import CrawlerProcess
-from hyper_scraper.spiders.walmart_spider import WalmartNintendoSwitchSpider
-from db.dao import Dao
-from notifs import slack
 
+USAGE = 'Usage: main.py [stock|daemon|sharded [workers]|compact|events|report]'
 
-if __name__ == '__main__':
-    Dao.setup_db()
-
-    if len(sys.argv) > 1:
-        if sys.argv[1] == 'stock':
-            s = Dao.products_in_stock()
-            slack.send_message(s)
-            print(s)
-            exit(0)
-        else:
-            print('Usage: main.py [stock]')
-            exit(1)
-
-    process = CrawlerProcess()
-    process.crawl(WalmartNintendoSwitchSpider)
+
+def project_settings():
+    """Return the project's settings module, read without Scrapy, so
+    -s options and settings set by spiders don't apply.
+    """
+    return importlib.import_module(os.environ.get('SCRAPY_SETTINGS_MODULE', 'hyper_scraper.settings'))
+
+
+def open_dao(read_only: bool = False):
+    """Return the project's Dao. A read-only Dao of a db that is missing or
+    not fully migrated yet creates or migrates it first.
+    """
+    from db.dao import Dao
+
+    settings = project_settings()
+    dao = Dao.from_url(settings.DATABASE_URL, settings.DATABASE_POOL_SIZE, settings.HISTORY_DIR, read_only)
+    if not read_only:
+        dao.setup_db()
+    elif not dao.is_migrated():
+        Dao.from_url(settings.DATABASE_URL, settings.DATABASE_POOL_SIZE, settings.HISTORY_DIR).setup_db()
+    return dao
+
+
+def crawl_settings():
+    """Return the Scrapy settings of the project, with the db set up."""
+    from scrapy.utils.project import get_project_settings
+    from db.dao import Dao
+
+    settings = get_project_settings()
+    Dao.from_settings(settings).setup_db()
+    return settings
+
+
+def stock(argv: [str]):
+    from notifs import slack
+
+    s = open_dao(read_only=True).products_in_stock()
+    slack.send_message(s)
+    print(s)
+
+
+def daemon(argv: [str]):
+    from hyper_scraper.daemon import run_daemon
+
+    run_daemon(crawl_settings())
+
+
+def sharded(argv: [str]):
+    from scrapy.utils.log import configure_logging
+    from hyper_scraper.sharding import default_workers, run_sharded
+
+    settings = crawl_settings()
+    workers = int(argv[0]) if argv else settings.getint('SHARD_WORKERS')
+    configure_logging(settings)
+    run_sharded(settings, workers or default_workers())
+
+
+def compact(argv: [str]):
+    dao = open_dao()
+    moved = dao.compact_history(project_settings().HISTORY_HOT_FOR)
+    print('Compacted {} stock changes into {}'.format(moved, dao.history_dir))
+
+
+def events(argv: [str]):
+    import logging
+    import signal
+    import threading
+    from notifs.events import SHUTDOWN_TIMEOUT, EventDispatcher
+
+    logging.basicConfig(level=logging.INFO)
+    dispatcher = EventDispatcher.from_settings(open_dao(), vars(project_settings()))
+    if not dispatcher.subscribers:
+        print('No EVENT_SUBSCRIBERS to deliver stock events to')
+        return
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    dispatcher.start()
+    try:
+        while not stopped.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    dispatcher.stop(SHUTDOWN_TIMEOUT)
+
+
+def report(argv: [str]):
+    from db import analytics  # needs numpy
+
+    analytics.main(argv, open_dao(read_only=True))
+
+
+def crawl(argv: [str]):
+    from scrapy.crawler import CrawlerProcess
+    from hyper_scraper.watchlist import load_watchlist
+
+    settings = crawl_settings()
+    process = CrawlerProcess(settings)
+    for retailer in load_watchlist(settings.get('WATCHLIST_FILE')):
+        process.crawl(retailer)  # spiders are named after their retailer
     process.start()
+
+
+COMMANDS = {
+    'stock': stock,
+    'daemon': daemon,
+    'sharded': sharded,
+    'compact': compact,
+    'events': events,
+    'report': report,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] not in COMMANDS:
+        print(USAGE)
+        exit(1)
+
+    command = COMMANDS[sys.argv[1]] if len(sys.argv) > 1 else crawl
+    command(sys.argv[2:])
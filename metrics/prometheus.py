@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Counters, gauges and histograms exported in the Prometheus text format,
+over HTTP or to a node_exporter textfile collector.
+"""
+from time import perf_counter
+import functools
+import os
+import threading
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: (str,), values: (str,), extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: (str,) = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}  # label values:value
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> (str,):
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} takes labels {}, got {}'.format(self.name, self.label_names, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> [(str, str, float)]:
+        """Return the (name, labels, value) of every sample."""
+        with self._lock:
+            return [(self.name, _format_labels(self.label_names, key), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: (str,) = (), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function  # reads the value of an unlabelled gauge when collected
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> [(str, str, float)]:
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        return super().samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: (str,) = (), buckets: (float,) = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]  # [bucket counts, sum]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+
+    def time(self, **labels):
+        """Decorate a function to observe how long each call takes."""
+        def decorator(f):
+            @functools.wraps(f)
+            def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(perf_counter() - start, **labels)
+            return timed
+        return decorator
+
+    def samples(self) -> [(str, str, float)]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket',
+                                    _format_labels(self.label_names, key, 'le="{}"'.format(_format_value(bound))),
+                                    cumulative))
+                labels = _format_labels(self.label_names, key)
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}  # name:metric
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Register metric, or return the already registered metric of the
+        same name and type.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError('metric {} is already registered differently'.format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: (str,) = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: (str,) = (), function=None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels, function))
+
+
+def histogram(name: str, documentation: str, labels: (str,) = (), buckets: (float,) = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def write_textfile(path: str) -> None:
+    """Write every metric to path for a textfile collector. The file is
+    replaced atomically so the collector never reads a partial file.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def serve(port: int, host: str = '127.0.0.1'):
+    """Serve /metrics on host:port from a background thread. Only the first
+    call starts a server, later calls return it.
+    """
+    # Imported here, most processes only define metrics and never serve them
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), Handler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+        return _server
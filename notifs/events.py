@@ -0,0 +1,271 @@
+"""Delivers the db's stock event log to subscribers.
+
+Recording stock appends an event to the log for every restock, sell out and
+price change, once per change however many crawls observed it (see
+Dao.record_latest_product_stock_batch). Each subscriber, e.g. slack, a
+webhook or a file, reads the log from its own offset in a thread of its own,
+so a slow or failing subscriber falls behind without holding up the crawl
+or the other subscribers.
+
+A subscriber is delivered to by one process at a time, the one holding its
+lease in the db, so processes running a dispatcher at once don't deliver
+events twice. Offsets are saved after each delivered batch: a batch is
+delivered again if the process dies or loses the lease while delivering it.
+"""
+from collections import OrderedDict
+from db.dao import PRICE_CHANGE, RESTOCK, SOLD_OUT, Dao, StockEvent
+from metrics import prometheus
+from notifs import slack
+import abc
+import atexit
+import importlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Longest to wait at exit for subscribers to catch up with the log
+SHUTDOWN_TIMEOUT = 30.0
+
+DELIVERED = prometheus.counter('hyper_scraper_events_delivered_total', 'Stock events delivered', ('subscriber',))
+FAILURES = prometheus.counter('hyper_scraper_event_delivery_failures_total', 'Failed stock event deliveries',
+                              ('subscriber',))
+
+
+class SubscriberNotConfigured(Exception):
+    """Raised by Subscriber.from_settings when the settings or environment
+    leave the subscriber nowhere to deliver to. The subscriber is skipped.
+    """
+
+
+def load_class(path: str):
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def event_message(event: StockEvent) -> str:
+    """Return the slack message of a stock event."""
+    if event.kind == RESTOCK:
+        return '{}: {} - price ${}, availability {}'.format(event.product_name, event.location, event.price,
+                                                            event.quantity)
+    if event.kind == SOLD_OUT:
+        return '{}: {} - sold out'.format(event.product_name, event.location)
+    if event.kind == PRICE_CHANGE:
+        return '{}: {} - price ${} -> ${}, availability {}'.format(event.product_name, event.location,
+                                                                   event.old_price, event.price, event.quantity)
+    return '{}: {} - {}'.format(event.product_name, event.location, event.kind)
+
+
+class Subscriber(abc.ABC):
+    """Delivers batches of stock events somewhere. deliver() raises to have
+    the batch delivered again later.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @classmethod
+    def from_settings(cls, name: str, settings) -> 'Subscriber':
+        return cls(name)
+
+    @abc.abstractmethod
+    def deliver(self, events: [StockEvent]) -> None:
+        """Deliver events, oldest first, or raise."""
+
+    def close(self) -> None:
+        pass
+
+
+class SlackSubscriber(Subscriber):
+    """Posts a message per event to the HYPRSCRP_SLACK_HOOK_URL channel, and
+    waits up to flush_timeout seconds for them to be sent. A batch that
+    isn't all sent in time, or with a post given up on meanwhile, fails and
+    is delivered again. Not configured without the hook, so events wait in
+    the log until it is set.
+    """
+
+    def __init__(self, name: str, flush_timeout: float = 60.0):
+        super().__init__(name)
+        self.flush_timeout = flush_timeout
+
+    @classmethod
+    def from_settings(cls, name: str, settings) -> 'Subscriber':
+        if not slack.message_hook_url():
+            raise SubscriberNotConfigured('HYPRSCRP_SLACK_HOOK_URL is not set')
+        return cls(name)
+
+    def deliver(self, events: [StockEvent]) -> None:
+        if not slack.message_hook_url():
+            raise SubscriberNotConfigured('HYPRSCRP_SLACK_HOOK_URL is not set')
+        # Counts the notifier's other posts too, any failure meanwhile fails
+        # the batch
+        failed = slack.failed_posts()
+        for event in events:
+            if not slack.send_message(event_message(event)):
+                raise RuntimeError('the slack notification queue is full')
+        if not slack.flush(self.flush_timeout):
+            raise RuntimeError('timed out sending stock events to slack')
+        if slack.failed_posts() != failed:
+            raise RuntimeError('failed to post stock events to slack')
+
+
+class WebhookSubscriber(Subscriber):
+    """POSTs each batch to EVENT_WEBHOOK_URL as {"events": [event, ...]}, with
+    the fields of StockEvent. Any response but a 2xx is a failure.
+    """
+
+    def __init__(self, name: str, url: str, timeout: float = 10.0):
+        super().__init__(name)
+        self.url = url
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls, name: str, settings) -> 'Subscriber':
+        url = settings.get('EVENT_WEBHOOK_URL')
+        if not url:
+            raise ValueError('EVENT_WEBHOOK_URL is not set for the {} subscriber'.format(name))
+        return cls(name, url)
+
+    def deliver(self, events: [StockEvent]) -> None:
+        body = json.dumps({'events': [event._asdict() for event in events]}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'},
+                                         method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:  # raises on 4xx and 5xx
+            response.read()
+
+
+class FileSubscriber(Subscriber):
+    """Appends each event to EVENT_FILE as a line of JSON."""
+
+    def __init__(self, name: str, path: str):
+        super().__init__(name)
+        self.path = path
+
+    @classmethod
+    def from_settings(cls, name: str, settings) -> 'Subscriber':
+        return cls(name, settings.get('EVENT_FILE'))
+
+    def deliver(self, events: [StockEvent]) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(event._asdict()) + '\n' for event in events)
+
+
+class EventDispatcher:
+    """Delivers the stock event log to subscribers, in batches of up to
+    batch_size events, each from a thread of its own.
+
+    A subscriber that is caught up is polled every poll_interval seconds. A
+    failed delivery is retried after a backoff doubling up to max_backoff.
+    The lease on a subscriber lasts lease_for seconds and is renewed halfway,
+    so another process takes over within lease_for of this one dying.
+    """
+
+    def __init__(self, dao: Dao, subscribers: [Subscriber], batch_size: int = 100, poll_interval: float = 1.0,
+                 lease_for: float = 120.0, max_backoff: float = 300.0):
+        self.dao = dao
+        self.subscribers = subscribers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_for = lease_for
+        self.max_backoff = max_backoff
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self._stopping = threading.Event()
+        self._deadline = 0.0
+        self._threads = []
+
+    @classmethod
+    def from_settings(cls, dao: Dao, settings) -> 'EventDispatcher':
+        """Return the dispatcher of the EVENT_* settings, from Scrapy settings
+        or a dict of them. Subscribers that aren't configured are skipped.
+        """
+        subscribers = []
+        for name, path in OrderedDict(settings.get('EVENT_SUBSCRIBERS') or {}).items():
+            try:
+                subscribers.append(load_class(path).from_settings(name, settings))
+            except SubscriberNotConfigured as e:
+                logger.warning('Not delivering stock events to the %s subscriber: %s', name, e)
+        return cls(dao, subscribers, int(settings.get('EVENT_BATCH_SIZE', 100)),
+                   float(settings.get('EVENT_POLL_INTERVAL', 1.0)), float(settings.get('EVENT_LEASE_SECONDS', 120)),
+                   float(settings.get('EVENT_MAX_BACKOFF', 300)))
+
+    def start(self) -> None:
+        """Start delivering in background threads, until stop() or exit."""
+        for subscriber in self.subscribers:
+            thread = threading.Thread(target=self._run, args=(subscriber,), daemon=True,
+                                      name='event-subscriber-{}'.format(subscriber.name))
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.stop, SHUTDOWN_TIMEOUT)
+
+    def stop(self, timeout: float = None) -> None:
+        """Deliver the events already in the log, for up to timeout seconds,
+        then stop and give up the leases.
+        """
+        self._deadline = time.monotonic() + (timeout if timeout is not None else float('inf'))
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(max(0.0, self._deadline - time.monotonic()) if timeout is not None else None)
+        self._threads = []
+
+    def _run(self, subscriber: Subscriber):
+        cursor = _Cursor()
+        delay = 0.0
+        while not self._stopping.wait(delay):
+            delay = self._step(subscriber, cursor)
+
+        while time.monotonic() < self._deadline and self._step(subscriber, cursor) == 0:
+            pass  # catching up before stopping
+
+        try:
+            self.dao.release_event_subscriber(subscriber.name, self.owner)
+            subscriber.close()
+        except Exception:
+            logger.exception('Failed to stop the %s subscriber', subscriber.name)
+
+    def _step(self, subscriber: Subscriber, cursor: '_Cursor') -> float:
+        """Deliver the next batch of events to subscriber if this dispatcher
+        holds its lease. Return how long to wait before the next step.
+        """
+        try:
+            if cursor.offset is None or time.monotonic() >= cursor.renew_at:
+                cursor.offset = self.dao.lease_event_subscriber(subscriber.name, self.owner, self.lease_for)
+                cursor.renew_at = time.monotonic() + self.lease_for / 2
+                if cursor.offset is None:
+                    return self.poll_interval  # another process delivers to it
+
+            events = self.dao.stock_events(cursor.offset, self.batch_size)
+            if not events:
+                return self.poll_interval
+
+            subscriber.deliver(events)
+            if self.dao.save_event_offset(subscriber.name, self.owner, events[-1].offset):
+                cursor.offset = events[-1].offset
+            else:
+                cursor.offset = None  # the lease was lost while delivering
+        except Exception:
+            logger.exception('Failed to deliver stock events to the %s subscriber', subscriber.name)
+            FAILURES.inc(subscriber=subscriber.name)
+            cursor.failures += 1
+            return min(self.max_backoff, self.poll_interval * 2 ** min(cursor.failures, 16))
+
+        DELIVERED.inc(len(events), subscriber=subscriber.name)
+        cursor.failures = 0
+        return 0.0
+
+
+class _Cursor:
+    """Where a dispatcher thread is in the log of its subscriber."""
+    __slots__ = ('offset', 'renew_at', 'failures')
+
+    def __init__(self):
+        self.offset = None  # of the last delivered event, None without the lease
+        self.renew_at = 0.0
+        self.failures = 0
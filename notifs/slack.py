@@ -1,38 +1,268 @@
 #!/usr/bin/env python3
-from urllib import request
+from urllib.parse import urlsplit
+from metrics import prometheus
+import atexit
 import json
+import logging
 import os
+import queue
+import threading
+import time
 
+logger = logging.getLogger(__name__)
 
-def _send(slack_url: str, text: str) -> None:
-    post = {'text': text}
+# Slack truncates message text after 40k characters, but recommends keeping
+# it under 4k
+MAX_TEXT_LEN = 4000
 
-    try:
-        json_data = json.dumps(post)
-        req = request.Request(slack_url,
-                              data=json_data.encode('ascii'),
-                              headers={'Content-Type': 'application/json'})
-        request.urlopen(req)
-    except Exception as e:
-        print('failed to send message to slack: {}'.format(str(e)))
+# Longest to wait at exit for queued messages to be sent
+SHUTDOWN_TIMEOUT = 60.0
+
+SEND_SECONDS = prometheus.histogram('hyper_scraper_slack_send_seconds',
+                                    'Time to post a slack message, including retries')
+SENT = prometheus.counter('hyper_scraper_slack_posts_total', 'Slack posts by outcome', ('result',))
+DROPPED = prometheus.counter('hyper_scraper_slack_dropped_messages_total',
+                             'Slack messages dropped because the queue was full')
+
+
+def _batch_texts(texts: [str], max_len: int) -> [str]:
+    """Join texts by newlines into as few posts as possible, each at most
+    max_len characters. Texts longer than max_len are split.
+    """
+    posts = []
+    post = ''
+    for text in texts:
+        text = text.rstrip('\n')
+        while len(text) > max_len:
+            posts.append(text[:max_len])
+            text = text[max_len:]
+
+        if post and len(post) + 1 + len(text) > max_len:
+            posts.append(post)
+            post = ''
+        post = post + '\n' + text if post else text
+
+    if post:
+        posts.append(post)
+    return posts
+
+
+class SlackNotifier:
+    """Posts slack messages from a background thread so callers never block.
+
+    Messages are queued and coalesced per webhook: after the first message
+    arrives the worker waits batch_delay seconds for more, then posts them
+    joined into as few messages as Slack allows. One keep-alive connection is
+    kept per webhook host. Rate limited (429) posts are retried after the
+    Retry-After delay and other failures with exponential backoff.
+
+    If the queue is full new messages are dropped rather than blocking.
+    Posts still failing after max_retries are given up on and counted by
+    failed_posts().
+    """
+
+    def __init__(self, max_queue: int = 10000, batch_delay: float = 1.0, max_retries: int = 5,
+                 backoff: float = 1.0, max_backoff: float = 30.0, timeout: float = 10.0):
+        self.batch_delay = batch_delay
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self._queue = queue.Queue(max_queue)  # (url, text), None to stop
+        self._connections = {}  # (scheme, netloc):HTTPConnection
+        self._pending = 0
+        self._failed = 0
+        self._pending_cond = threading.Condition()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def send(self, slack_url: str, text: str) -> bool:
+        """Queue text to be posted to slack_url. Return false if the message
+        was dropped because the queue is full.
+        """
+        self._ensure_started()
+        with self._pending_cond:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((slack_url, text))
+        except queue.Full:
+            self._done(1)
+            DROPPED.inc()
+            logger.warning('Failed to send message to slack: notification queue is full')
+            return False
+        return True
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def failed_posts(self) -> int:
+        """Return how many posts have been given up on so far."""
+        return self._failed
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until all queued messages have been sent or given up on.
+        Return false on timeout.
+        """
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self, timeout: float = None) -> None:
+        """Flush queued messages and stop the worker thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+
+        self._queue.put((None, None))
+        thread.join(timeout)
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slack-notifier', daemon=True)
+                self._thread.start()
+
+    def _done(self, n: int):
+        with self._pending_cond:
+            self._pending -= n
+            self._pending_cond.notify_all()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while batch[-1][0] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            if batch[-1][0] is None:
+                stopping = True
+                batch.pop()
+
+            by_url = {}  # url:[texts]
+            for url, text in batch:
+                by_url.setdefault(url, []).append(text)
+
+            for url, texts in by_url.items():
+                for post in _batch_texts(texts, MAX_TEXT_LEN):
+                    self._post(url, post)
+
+            self._done(len(batch))
+
+    @SEND_SECONDS.time()
+    def _post(self, slack_url: str, text: str):
+        body = json.dumps({'text': text}).encode('utf-8')
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, retry_after = self._request(slack_url, body)
+            except Exception as e:
+                status, retry_after = str(e), None
+
+            if status == 200:
+                SENT.inc(result='sent')
+                return
+
+            if attempt == self.max_retries:
+                break
+
+            if status == 429 and retry_after is not None:
+                time.sleep(retry_after)
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+        SENT.inc(result='failed')
+        self._failed += 1
+        logger.error('Failed to send message to slack: %s', status)
+
+    def _request(self, slack_url: str, body: bytes) -> (object, float):
+        """Post body over a kept-alive connection. Return the HTTP status and
+        the Retry-After delay in seconds, if given.
+        """
+        url = urlsplit(slack_url)
+        key = (url.scheme, url.netloc)
+        conn = self._connections.get(key)
+        if conn is None:
+            import http.client  # and ssl, only once a message is posted
+            conn_cls = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            conn = conn_cls(url.netloc, timeout=self.timeout)
+            self._connections[key] = conn
+
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        try:
+            conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+        except Exception:
+            # Drop the connection so the next attempt reconnects
+            conn.close()
+            del self._connections[key]
+            raise
+
+        retry_after = response.getheader('Retry-After')
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+            del self._connections[key]
+        return response.status, float(retry_after) if retry_after else None
+
+
+_notifier = SlackNotifier()
+atexit.register(_notifier.shutdown, SHUTDOWN_TIMEOUT)
+prometheus.gauge('hyper_scraper_slack_queue_depth', 'Slack messages waiting to be sent',
+                 function=_notifier.queue_depth)
+
+
+def _send(slack_url: str, text: str) -> bool:
+    return _notifier.send(slack_url, text)
+
+
+def flush(timeout: float = None) -> bool:
+    """Wait until all queued messages have been sent."""
+    return _notifier.flush(timeout)
+
+
+def queue_depth() -> int:
+    return _notifier.queue_depth()
+
+
+def failed_posts() -> int:
+    """Return how many posts have been given up on so far."""
+    return _notifier.failed_posts()
 
 
 def send_health_message(text: str) -> None:
     slack_url = os.getenv('HYPRSCRP_HEALTH_SLACK_HOOK_URL', '')
     if slack_url == '':
-        print('failed to send message to slack: HYPRSCRP_HEALTH_SLACK_HOOK_URL not set')
+        logger.warning('Failed to send message to slack: HYPRSCRP_HEALTH_SLACK_HOOK_URL not set')
         return
 
     _send(slack_url, text)
 
 
-def send_message(text) -> None:
-    slack_url = os.getenv('HYPRSCRP_SLACK_HOOK_URL', '')
+def message_hook_url() -> str:
+    """Return the webhook of stock messages, '' if not set."""
+    return os.getenv('HYPRSCRP_SLACK_HOOK_URL', '')
+
+
+def send_message(text) -> bool:
+    """Queue a stock message. Return false if it can't be sent."""
+    slack_url = message_hook_url()
     if slack_url == '':
-        print('failed to send message to slack: HYPRSCRP_SLACK_HOOK_URL not set')
-        return
+        logger.warning('Failed to send message to slack: HYPRSCRP_SLACK_HOOK_URL not set')
+        return False
 
-    _send(slack_url, text)
+    return _send(slack_url, text)
 
 
 if __name__ == '__main__':